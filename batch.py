@@ -0,0 +1,167 @@
+'''Converts a number of epub files to Netilt XML using a pool of processes.
+
+Usage: python batch.py [options] OUTPUT_DIR EPUB_FILE_OR_DIR [EPUB_FILE_OR_DIR ...]'''
+import os, sys, time, json, logging, traceback
+import argparse
+from multiprocessing import Pool
+
+from constants import PARSER_AUTO, PARSER_SOUP
+from epub import DRMEpubException
+from toc import InvalidEpubException
+from netilt import NetiltDoc
+from cache import ConversionCache
+from stats import Stats
+from fileutil import find_epub_files
+
+REPORT_FILENAME = 'report.json'
+
+# Cache of each cache directory, it is kept for all the books converted by the process,
+# so that the size of the cache is not taken from the directory for every book
+_caches = {}
+
+
+def get_output_filename(epub_filename, output_dir, root=None):
+    '''Returns name of the XML file for epub_filename: its name in output_dir or, if root
+    directory is given, its path relative to root'''
+    if root is None:
+        name = os.path.basename(epub_filename)
+    else:
+        name = os.path.relpath(os.path.abspath(epub_filename), root)
+    return os.path.join(output_dir, os.path.splitext(name)[0] + '.xml')
+
+def get_output_filenames(epub_filenames, output_dir):
+    '''Returns names of XML files for epub_filenames. Books are named after their files,
+    but books having the same name (e.g. a/book.epub and b/Book.epub found in subdirectories)
+    are written under their paths relative to the common directory of them (a/book.xml, b/Book.xml).
+    Names are compared ignoring case, as they are the same on case-insensitive file systems;
+    names which are still the same (e.g. of Book.epub and book.epub in one directory)
+    get a number suffix (Book.xml, book-2.xml)'''
+    def get_name(epub_filename):
+        return os.path.splitext(os.path.basename(epub_filename))[0].lower()
+    books_by_name = {}
+    for epub_filename in epub_filenames:
+        books_by_name.setdefault(get_name(epub_filename), []).append(epub_filename)
+    roots = {}
+    for (name, books) in books_by_name.items():
+        if len(books) > 1:
+            directories = [os.path.dirname(os.path.abspath(book)).split(os.sep) for book in books]
+            roots[name] = os.sep.join(os.path.commonprefix(directories)) or os.sep
+    output_filenames = []
+    used_names = set()
+    for epub_filename in epub_filenames:
+        output_filename = get_output_filename(epub_filename, output_dir, roots.get(get_name(epub_filename)))
+        (base, extension) = os.path.splitext(output_filename)
+        number = 1
+        while output_filename.lower() in used_names:
+            number += 1
+            output_filename = '%s-%d%s' % (base, number, extension)
+        used_names.add(output_filename.lower())
+        output_filenames.append(output_filename)
+    return output_filenames
+
+def unique_files(filenames):
+    '''Returns filenames without the files given already (the same file might be given
+    by different paths, e.g. a directory and a book in it), in their order'''
+    seen = set()
+    unique = []
+    for filename in filenames:
+        path = os.path.realpath(filename)
+        if path not in seen:
+            seen.add(path)
+            unique.append(filename)
+    return unique
+
+def get_stats_filename(output_filename):
+    return os.path.splitext(output_filename)[0] + '.stats.json'
+
+def get_cache(cache_dir):
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = ConversionCache(cache_dir)
+    return cache
+
+def convert_book(task):
+    '''Converts single book, task is (epub filename, output filename, use_spine_as_toc, parser_mode,
+    cache directory or None, with_stats). With with_stats, stats of the conversion are written
+    next to the output (see get_stats_filename).
+    Returns dict describing the result; errors are reported rather than raised'''
+    (epub_filename, output_filename, use_spine_as_toc, parser_mode, cache_dir, with_stats) = task
+    result = {'epub': epub_filename, 'output': None, 'error': None}
+    start = time.time()
+    try:
+        cache = get_cache(cache_dir) if cache_dir is not None else None
+        stats = Stats() if with_stats else None
+        NetiltDoc(epub_filename, parser_mode=parser_mode, cache=cache, stats=stats).write(output_filename, use_spine_as_toc)
+        result['output'] = output_filename
+        if stats is not None:
+            stats.dump(get_stats_filename(output_filename))
+    except (InvalidEpubException, DRMEpubException), e:
+        # UnknownContentException is a subclass of InvalidEpubException
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    except Exception, e:
+        logging.error('Failed to convert %s\n%s' % (epub_filename, traceback.format_exc()))
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+def convert_books(epub_filenames, output_dir, processes=None, use_spine_as_toc=True, parser_mode=PARSER_AUTO,
+                  cache_dir=None, with_stats=False):
+    '''Converts epub_filenames into output_dir with a pool of processes (a process per CPU by default;
+    with processes=1 books are converted in the current process). Books converted earlier
+    are taken from ConversionCache in cache_dir, if given. With with_stats, stats of each conversion
+    are written as JSON next to its output.
+    Books given several times are converted once.
+    Returns the report: numbers of books, converted and failed books, time spent and results for each book'''
+    epub_filenames = unique_files(epub_filenames)
+    output_filenames = get_output_filenames(epub_filenames, output_dir)
+    for directory in set([output_dir] + [os.path.dirname(filename) for filename in output_filenames]):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    tasks = [(epub_filename, output_filename, use_spine_as_toc, parser_mode, cache_dir, with_stats)
+             for (epub_filename, output_filename) in zip(epub_filenames, output_filenames)]
+    start = time.time()
+    if processes == 1:
+        results = [convert_book(task) for task in tasks]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(convert_book, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    seconds = time.time() - start
+    failed = [result for result in results if result['error'] is not None]
+    return {
+        'books': len(results),
+        'converted': len(results) - len(failed),
+        'failed': len(failed),
+        'seconds': seconds,
+        'books_per_second': len(results) / seconds if seconds else 0,
+        'results': results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts epub files to Netilt XML')
+    parser.add_argument('output_dir', help='directory for XML files and %s' % REPORT_FILENAME)
+    parser.add_argument('paths', nargs='+', help='epub files or directories with them')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--nav-points', action='store_true', help='build pages from NCX navpoints rather than from the spine')
+    parser.add_argument('--cache-dir', default=None, help='directory of the cache of converted books')
+    parser.add_argument('--stats', action='store_true', help='write timings of conversion stages next to each XML file')
+    parser.add_argument('--parser', choices=(PARSER_AUTO, PARSER_SOUP), default=PARSER_AUTO, help='parser mode for page content')
+    args = parser.parse_args(argv)
+
+    report = convert_books(find_epub_files(args.paths), args.output_dir, args.processes,
+                           use_spine_as_toc=not args.nav_points, parser_mode=args.parser,
+                           cache_dir=args.cache_dir, with_stats=args.stats)
+    with open(os.path.join(args.output_dir, REPORT_FILENAME), 'w') as f:
+        json.dump(report, f, indent=2)
+    for result in report['results']:
+        if result['error'] is not None:
+            print 'FAILED %s: %s' % (result['epub'], result['error'])
+    print 'Converted %(converted)d of %(books)d books in %(seconds).1fs (%(books_per_second).2f books/sec)' % report
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+'''Benchmarks for the conversion pipeline. Run from the command line: python benchmarks.py --help
+
+Every stage of the conversion is timed on test_data books and on generated synthetic ones.
+Each run of a stage is done in a separate process, so that its memory use could be measured:
+memory is the peak resident set size of the process while the stage runs over the size before
+the run. The peak is reset before the run where Linux allows it, elsewhere the size is sampled
+during the run.
+Results could be saved as JSON and compared with results saved earlier.'''
+import os, sys, time, json, resource, tempfile, shutil
+import threading
+from zipfile import ZipFile
+import argparse
+from multiprocessing import Process, Pipe
+
+from lxml import etree
+
+from epub import EpubArchive, EpubPage, parse_html, normalize_text
+from toc import TOC
+from netilt import NetiltDoc
+from synthetic import synthetic_page, synthetic_ncx, make_epub
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+TEST_BOOKS = ("in1.epub", "sicp.epub")
+
+
+def timed(func, repeat=3):
+    '''Returns the best time of repeat runs of func, in seconds'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds):
+    print "%-56s %9.4fs" % (name, seconds)
+
+def bench_toc():
+    for navpoints_count in (2000, 5000, 20000):
+        ncx = synthetic_ncx(navpoints_count)
+        toc = TOC(ncx)
+        report("TOC parse, %d navpoints" % navpoints_count, timed(lambda: TOC(ncx)))
+        def find_all():
+            for point in toc.tree:
+                point.find_children()
+                toc.find_point_by_id(point.id)
+        report("TOC find_children, find_point_by_id, %d navpoints" % navpoints_count, timed(find_all))
+        def find_descendants():
+            for point in toc.find_points(1):
+                toc.find_descendants(point)
+        report("TOC find_descendants, %d navpoints" % navpoints_count, timed(find_descendants))
+
+def bench_parse_sections():
+    pages = []
+    directory = os.path.join(TEST_DATA, "page_sections")
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".html"):
+            pages.append((name, open(os.path.join(directory, name)).read()))
+    for elements_count in (5000, 10000, 20000, 50000):
+        pages.append(("synthetic %d" % elements_count, synthetic_page(elements_count)))
+        pages.append(("synthetic %d, 1 heading" % elements_count, synthetic_page(elements_count, elements_count)))
+    for name, html in pages:
+        page = EpubPage(None, None, None, html, None, None)
+        def parse_sections():
+            page._sections = []
+            page.parse_sections()
+        report("parse_sections %s" % name, timed(parse_sections))
+
+def reference_normalize_text(text_content):
+    '''normalize_text replacing "&nbsp;" before splitting, as it used to'''
+    if not isinstance(text_content, unicode):
+        text_content = unicode(text_content, "UTF-8")
+    return " ".join(text_content.replace(u"\u00A0", " ").split())
+
+def bench_normalize_text():
+    documents = []
+    for book in TEST_BOOKS:
+        z = ZipFile(os.path.join(TEST_DATA, book))
+        content = "".join([z.read(name) for name in z.namelist() if name.endswith(("html", ".xml"))])
+        documents.append(("%s content files" % book, content))
+    documents.append(("synthetic 200000", synthetic_page(200000)))
+    for name, content in documents:
+        report("reference_normalize_text %s" % name, timed(lambda: reference_normalize_text(content)))
+        report("normalize_text %s" % name, timed(lambda: normalize_text(content)))
+        report("normalize_text %s, keep_whitespace" % name, timed(lambda: normalize_text(content, True)))
+
+
+# Stages of the conversion. Each stage is a function taking epub filename and use_spine_as_toc,
+# it prepares whatever the stage needs and returns a function running the stage itself
+
+def stage_explode(epub_filename, use_spine_as_toc):
+    '''Reading of container, OPF and NCX and creation of (not loaded) pages of lazy archive'''
+    return lambda: EpubArchive(epub_filename, use_spine_as_toc, lazy=True)
+
+def stage_explode_eager(epub_filename, use_spine_as_toc):
+    '''Reading of container, OPF and NCX and creation of pages, which are read and parsed
+    by the (not lazy) archive right away'''
+    return lambda: EpubArchive(epub_filename, use_spine_as_toc)
+
+def stage_toc(epub_filename, use_spine_as_toc):
+    package = EpubArchive(epub_filename, use_spine_as_toc, lazy=True).package
+    return lambda: TOC(package.toc, package.opf)
+
+def read_pages(epub_filename, use_spine_as_toc):
+    '''Returns lazy pages of the archive along with their normalized content.
+    Shared files are not split, so that every page is parsed by parse_page_content'''
+    archive = EpubArchive(epub_filename, use_spine_as_toc, lazy=True, split_shared_files=False)
+    pages = []
+    for page in archive.pages:
+        file_content = page._file_content
+        if callable(file_content):
+            file_content = file_content()
+        pages.append((page, normalize_text(file_content)))
+    return pages
+
+def stage_parse_page_content(epub_filename, use_spine_as_toc):
+    '''Parsing of pages and pruning of their ranges'''
+    pages = read_pages(epub_filename, use_spine_as_toc)
+    def run():
+        for (page, page_content) in pages:
+            page.parse_page_content(page_content)
+    return run
+
+def stage_find_bounding_elements(epub_filename, use_spine_as_toc):
+    bodies = []
+    for (page, page_content) in read_pages(epub_filename, use_spine_as_toc):
+        if page.current_anchor is not None:
+            bodies.append((page, parse_html(page_content, page.archive.parser_mode)[0].find('.//body')))
+    def run():
+        for (page, body) in bodies:
+            page.find_bounding_elements(body)
+    return run
+
+def stage_parse_sections(epub_filename, use_spine_as_toc):
+    pages = EpubArchive(epub_filename, use_spine_as_toc).pages
+    def run():
+        for page in pages:
+            page._sections = []
+            page.parse_sections()
+    return run
+
+def stage_get_netilt_xml(epub_filename, use_spine_as_toc):
+    '''Whole conversion but serialization'''
+    return lambda: NetiltDoc(epub_filename).get_netilt_xml(use_spine_as_toc)
+
+def stage_serialization(epub_filename, use_spine_as_toc):
+    document = NetiltDoc(epub_filename).get_netilt_xml(use_spine_as_toc)
+    return lambda: etree.tostring(document, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+
+def stage_process(epub_filename, use_spine_as_toc):
+    return lambda: NetiltDoc(epub_filename).process(use_spine_as_toc)
+
+def stage_write(epub_filename, use_spine_as_toc):
+    '''Streaming conversion'''
+    def run():
+        with open(os.devnull, "wb") as output:
+            NetiltDoc(epub_filename).write(output, use_spine_as_toc)
+    return run
+
+STAGES = (
+    ("explode", stage_explode),
+    ("explode_eager", stage_explode_eager),
+    ("toc", stage_toc),
+    ("parse_page_content", stage_parse_page_content),
+    ("find_bounding_elements", stage_find_bounding_elements),
+    ("parse_sections", stage_parse_sections),
+    ("get_netilt_xml", stage_get_netilt_xml),
+    ("serialization", stage_serialization),
+    ("process", stage_process),
+    ("write", stage_write),
+)
+
+
+def current_rss_kb():
+    '''Returns resident set size of the process, or its peak if the current one is unknown'''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return peak_rss_kb()
+
+def peak_rss_kb():
+    '''Returns peak resident set size of the process since the start or since reset_peak_rss'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes rather than kilobytes
+        peak /= 1024
+    return peak
+
+def reset_peak_rss():
+    '''Resets peak resident set size of the process to the current one (Linux 4.0 and later).
+    Returns whether it is done'''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+class RssSampler(threading.Thread):
+    '''Samples resident set size of the process until it is stopped, keeping the peak one'''
+
+    def __init__(self, interval=0.001):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak_kb = current_rss_kb()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak_kb = max(self.peak_kb, current_rss_kb())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak_kb = max(self.peak_kb, current_rss_kb())
+        return self.peak_kb
+
+def _run_stage(connection, stage, epub_filename, use_spine_as_toc):
+    try:
+        run = stage(epub_filename, use_spine_as_toc)
+        rss = current_rss_kb()
+        # Peak of the process might be reached by the setup of the stage,
+        # so it is reset or the size is sampled while the stage runs
+        sampler = None
+        if not reset_peak_rss():
+            sampler = RssSampler()
+            sampler.start()
+        start = time.time()
+        run()
+        seconds = time.time() - start
+        peak_kb = sampler.stop() if sampler is not None else peak_rss_kb()
+        connection.send((seconds, max(peak_kb - rss, 0), None))
+    except Exception, e:
+        connection.send((None, None, "%s: %s" % (e.__class__.__name__, e)))
+    connection.close()
+
+def run_stage(stage, epub_filename, use_spine_as_toc):
+    '''Runs the stage in a new process and returns tuple (seconds, memory in kilobytes)'''
+    (parent_connection, child_connection) = Pipe()
+    process = Process(target=_run_stage, args=(child_connection, stage, epub_filename, use_spine_as_toc))
+    process.start()
+    (seconds, memory_kb, error) = parent_connection.recv()
+    process.join()
+    if error is not None:
+        raise RuntimeError("Stage failed on %s: %s" % (epub_filename, error))
+    return (seconds, memory_kb)
+
+def bench_book(name, epub_filename, stages=None, repeat=3):
+    '''Returns results of the stages run on the book in both spine and navpoints modes:
+    the best time and the biggest memory growth of repeat runs'''
+    results = []
+    for use_spine_as_toc in (True, False):
+        mode = "spine" if use_spine_as_toc else "navpoints"
+        for (stage_name, stage) in STAGES:
+            if stages and stage_name not in stages:
+                continue
+            runs = [run_stage(stage, epub_filename, use_spine_as_toc) for i in range(repeat)]
+            result = {
+                "book": name,
+                "mode": mode,
+                "stage": stage_name,
+                "seconds": min([seconds for (seconds, memory_kb) in runs]),
+                "memory_kb": max([memory_kb for (seconds, memory_kb) in runs]),
+            }
+            print "%-64s %9.4fs %9dKB" % ("%s, %s, %s" % (name, mode, stage_name), result["seconds"], result["memory_kb"])
+            results.append(result)
+    return results
+
+def result_key(result):
+    return (result["book"], result["mode"], result["stage"])
+
+def compare(results, baseline, threshold):
+    '''Prints ratios of results to baseline ones, returns results slower than the baseline
+    by more than threshold (ratio)'''
+    baseline_results = dict([(result_key(result), result) for result in baseline["results"]])
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(result_key(result))
+        if baseline_result is None:
+            continue
+        ratio = result["seconds"] / baseline_result["seconds"] if baseline_result["seconds"] else 1.0
+        marker = ""
+        if ratio > threshold:
+            marker = "  SLOWER"
+            regressions.append(result)
+        print "%-64s %9.4fs %9.4fs %6.2fx %9dKB%s" % (
+            "%s, %s, %s" % result_key(result), baseline_result["seconds"], result["seconds"], ratio,
+            result["memory_kb"] - baseline_result["memory_kb"], marker
+        )
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the conversion stages")
+    parser.add_argument("--output", help="save results as JSON to the file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare results with ones saved earlier")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="time ratio to the baseline considered a regression (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage (default: %(default)s)")
+    parser.add_argument("--stage", action="append", choices=[name for (name, stage) in STAGES],
+                        help="run only this stage (could be given several times)")
+    parser.add_argument("--book", action="append", help="epub file to run stages on (default: test_data books)")
+    parser.add_argument("--files", type=int, default=20, help="content files of the synthetic book (default: %(default)s)")
+    parser.add_argument("--navpoints-per-file", type=int, default=5,
+                        help="navpoints in each file of the synthetic book (default: %(default)s)")
+    parser.add_argument("--elements-per-page", type=int, default=5000,
+                        help="elements in each file of the synthetic book (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="nesting depth of navpoints of the synthetic book (default: %(default)s)")
+    parser.add_argument("--malformed-every", type=int, default=0,
+                        help="every N-th file of the synthetic book is not well-formed (default: none)")
+    parser.add_argument("--no-synthetic", action="store_true", help="don't generate synthetic book")
+    parser.add_argument("--micro", action="store_true", help="run micro benchmarks of parse_sections, TOC and normalize_text instead")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        bench_parse_sections()
+        bench_toc()
+        bench_normalize_text()
+        return 0
+
+    books = [(os.path.basename(book), book) for book in args.book or []]
+    if not books:
+        books = [(book, os.path.join(TEST_DATA, book)) for book in TEST_BOOKS]
+    directory = tempfile.mkdtemp()
+    try:
+        if not args.no_synthetic:
+            synthetic_filename = os.path.join(directory, "synthetic.epub")
+            make_epub(synthetic_filename, args.files, args.navpoints_per_file, args.elements_per_page,
+                      depth=args.depth, malformed_every=args.malformed_every)
+            books.append(("synthetic-%d-%d-%d-%d-%d" % (args.files, args.navpoints_per_file, args.elements_per_page,
+                                                        args.depth, args.malformed_every), synthetic_filename))
+        results = []
+        for (name, epub_filename) in books:
+            results.extend(bench_book(name, epub_filename, args.stage, args.repeat))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "lxml": etree.__version__, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print
+        print "%-64s %10s %10s %7s %11s" % ("", "baseline", "now", "ratio", "memory diff")
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
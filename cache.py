@@ -0,0 +1,321 @@
+'''Caches used while processing epub archives'''
+import os, json, time, hashlib, tempfile
+from collections import OrderedDict
+from zipfile import ZipFile
+
+from constants import VERSION
+from fileutil import is_filename, is_file_object, MappedZipFile
+
+
+class ParseCache(object):
+    '''LRU cache of parsed page content. It is bounded both by the number of entries
+    and by the total size of the source text of cached pages (parsed tree takes
+    several times more memory than its source).
+
+    By default every EpubArchive creates its own cache, but single cache could be
+    passed to several archives.'''
+
+    def __init__(self, max_entries=32, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns cached value or None'''
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        '''Caches value, evicting least recently used entries to fit into the limits.
+        Value bigger than max_bytes is not cached at all.'''
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            evicted_value, evicted_size = self._entries.popitem(last=False)[1]
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ZipFilePool(object):
+    '''Pool of open ZipFile handles shared by EpubArchives of the same files, so that
+    archives opened repeatedly (e.g. for metadata and then for content) neither open the file
+    nor read its central directory again. Handles are keyed by file name, size and modification
+    time, so a changed file is opened anew. At most max_handles of them are kept open:
+    least recently used handles not used by any archive are closed first, then ones in use
+    (archive takes a closed handle from the pool again when it reads the file, see is_open),
+    so that archives which are never closed do not hold the files open.
+
+    Handles are shared, so the pool is not to be used by several threads at once.'''
+
+    def __init__(self, max_handles=16):
+        self.max_handles = max_handles
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> [ZipFile, number of archives using it]
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def acquire(self, filename, use_mmap=False):
+        '''Returns ZipFile of filename, it is to be returned by release().
+        If use_mmap is set, the file is memory mapped (fileutil.MappedZipFile)
+        and unmapped when the pool closes the handle'''
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime, use_mmap)
+        entry = self._handles.pop(key, None)
+        if entry is None:
+            entry = [MappedZipFile(filename) if use_mmap else ZipFile(filename, 'r'), 0]
+            self.misses += 1
+        else:
+            self.hits += 1
+        entry[1] += 1
+        self._handles[key] = entry
+        self._evict()
+        return entry[0]
+
+    def release(self, zip_file):
+        '''Returns ZipFile taken by acquire(); a handle the pool has closed is ignored'''
+        for entry in self._handles.values():
+            if entry[0] is zip_file:
+                entry[1] -= 1
+        self._evict()
+
+    def is_open(self, zip_file):
+        '''Tells whether ZipFile taken by acquire() is still kept open by the pool'''
+        return any(entry[0] is zip_file for entry in self._handles.values())
+
+    def _evict(self):
+        for in_use in (False, True):
+            # The handle acquired last is not closed even if it is the only one
+            for key in list(self._handles)[:-1]:
+                if len(self._handles) <= self.max_handles:
+                    return
+                if (self._handles[key][1] > 0) == in_use:
+                    self._handles.pop(key)[0].close()
+                    self.evictions += 1
+
+    def close(self):
+        '''Closes all the handles'''
+        for (zip_file, users) in self._handles.values():
+            zip_file.close()
+        self._handles.clear()
+
+    def stats(self):
+        return {
+            "handles": len(self._handles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ConversionCache(object):
+    '''On-disk cache of converted books shared by processes. Entries are keyed by hash of
+    the epub file, conversion options and VERSION, each one is Netilt XML file and JSON file
+    with the skeleton of the book (see NetiltDoc.skeleton). Total size of the files is
+    bounded, least recently used entries are evicted.
+
+    The directory is listed just when the entries are to be evicted: size of the cache
+    is taken from the listing and then counted up by put(). As other processes add
+    entries as well, the directory is listed again after every scan_interval puts.
+    Entries are evicted down to low_water of max_bytes, so that the next eviction
+    is not due right away.'''
+
+    XML_SUFFIX = '.xml'
+    SKELETON_SUFFIX = '.json'
+    TMP_SUFFIX = '.tmp'
+    # Temporary files older than that are left by crashed writers
+    STALE_TMP_SECONDS = 60 * 60
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, low_water=0.9, scan_interval=100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.scan_interval = scan_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.scans = 0
+        # Size of the cache known from the last listing of the directory and the puts since
+        self._bytes = None
+        self._puts_since_scan = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, epub_filename, options):
+        '''Returns key for the conversion of epub_filename with options (tuple).
+        Like EpubArchive, it takes file object or content of the file (bytearray, memoryview,
+        buffer or mmap) as well'''
+        digest = hashlib.sha1()
+        if is_filename(epub_filename):
+            with open(epub_filename, 'rb') as f:
+                self._update_digest(digest, f)
+        elif is_file_object(epub_filename):
+            position = epub_filename.tell()
+            epub_filename.seek(0)
+            self._update_digest(digest, epub_filename)
+            epub_filename.seek(position)
+        else:
+            # Content of the file, hashed through the buffer interface without copying it
+            digest.update(epub_filename)
+        digest.update(repr((VERSION, options)))
+        return digest.hexdigest()
+
+    def _update_digest(self, digest, f):
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key):
+        '''Returns name of cached XML file or None'''
+        xml_filename = self._path(key, self.XML_SUFFIX)
+        try:
+            # Access time is not reliable, modification time marks the use of an entry
+            os.utime(xml_filename, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return xml_filename
+
+    def get_skeleton(self, key):
+        '''Returns cached skeleton or None'''
+        try:
+            with open(self._path(key, self.SKELETON_SUFFIX)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def new_file(self):
+        '''Returns temporary file in the cache directory to be passed to put'''
+        return tempfile.NamedTemporaryFile('wb', suffix=self.TMP_SUFFIX, dir=self.directory, delete=False)
+
+    def put(self, key, xml, skeleton):
+        '''Caches XML (string or closed file returned by new_file) and skeleton.
+        Files are renamed into place, so readers never see partially written entry'''
+        if isinstance(xml, basestring):
+            xml_file = self.new_file()
+            xml_file.write(xml)
+            xml_file.close()
+        else:
+            xml_file = xml
+        skeleton = json.dumps(skeleton)
+        skeleton_file = self.new_file()
+        skeleton_file.write(skeleton)
+        skeleton_file.close()
+        os.rename(skeleton_file.name, self._path(key, self.SKELETON_SUFFIX))
+        os.rename(xml_file.name, self._path(key, self.XML_SUFFIX))
+        self._puts_since_scan += 1
+        if self._bytes is None or self._puts_since_scan >= self.scan_interval:
+            self.evict()
+            return
+        self._bytes += len(skeleton) + os.path.getsize(self._path(key, self.XML_SUFFIX))
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self, sweep=False):
+        '''Returns list of (modification time, total size, key) of cached entries.
+        Temporary files are listed as entries without key, unless they are stale:
+        with sweep set, those are removed'''
+        entries = []
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.TMP_SUFFIX):
+                try:
+                    tmp_stat = os.stat(os.path.join(self.directory, filename))
+                    if sweep and tmp_stat.st_mtime < now - self.STALE_TMP_SECONDS:
+                        os.remove(os.path.join(self.directory, filename))
+                        continue
+                except OSError:
+                    # Renamed into place or removed by another process
+                    continue
+                entries.append((tmp_stat.st_mtime, tmp_stat.st_size, None))
+                continue
+            if not filename.endswith(self.XML_SUFFIX):
+                continue
+            key = filename[:-len(self.XML_SUFFIX)]
+            try:
+                xml_stat = os.stat(self._path(key, self.XML_SUFFIX))
+                skeleton_size = os.path.getsize(self._path(key, self.SKELETON_SUFFIX))
+            except OSError:
+                continue
+            entries.append((xml_stat.st_mtime, xml_stat.st_size + skeleton_size, key))
+        return entries
+
+    def _remove(self, key):
+        for suffix in (self.XML_SUFFIX, self.SKELETON_SUFFIX):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                # Removed by another process
+                pass
+
+    def evict(self):
+        '''Removes stale temporary files and, if the cache does not fit into max_bytes,
+        least recently used entries until they fit into low_water of it'''
+        entries = sorted(self._entries(sweep=True))
+        self.scans += 1
+        self._puts_since_scan = 0
+        size = sum([entry_size for (mtime, entry_size, key) in entries])
+        if size > self.max_bytes:
+            for (mtime, entry_size, key) in entries:
+                if size <= self.max_bytes * self.low_water:
+                    break
+                if key is None:
+                    # Temporary file being written
+                    continue
+                self._remove(key)
+                size -= entry_size
+                self.evictions += 1
+        self._bytes = size
+
+    def clear(self):
+        for (mtime, entry_size, key) in self._entries():
+            if key is not None:
+                self._remove(key)
+        self._bytes = None
+
+    def stats(self):
+        entries = [entry for entry in self._entries() if entry[2] is not None]
+        return {
+            "entries": len(entries),
+            "bytes": sum([entry_size for (mtime, entry_size, key) in entries]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "scans": self.scans,
+        }
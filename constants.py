@@ -29,6 +29,15 @@ DC_DESCRIPTION_TAG = 'description'
 
 BW_BOOK_CLASS = '#bw-book-content'
 
+# Version of conversion output, cached conversions of other versions are not used
+VERSION = '0.2'
+
+# Parser modes for page content
+PARSER_AUTO = 'auto' # well-formed XHTML is parsed with libxml2, anything else with BeautifulSoup
+PARSER_SOUP = 'soup' # always use BeautifulSoup
+# Parsers actually used for the page
+PARSER_XHTML = 'xhtml'
+
 # Types for various dc:identifiers  
 IDENTIFIER_URL = 'url'
 IDENTIFIER_ISBN = 'isbn'
@@ -6,18 +6,63 @@ import hashlib
 from lxml import etree
 #TODO: use => from lxml.html.clean import clean_html
 from zipfile import ZipFile
-import logging, datetime, os, os.path, lxml, lxml.html
+from cStringIO import StringIO
+from multiprocessing import Pool
+from threading import Thread, Lock
+import logging, datetime, os, os.path, re, time, shutil, lxml, lxml.html
 from urllib import unquote_plus
 from xml.parsers.expat import ExpatError
 
 import constants
 from constants import ENC, BW_BOOK_CLASS, STYLESHEET_MIMETYPE, XHTML_MIMETYPE, DTBOOK_MIMETYPE
+from constants import PARSER_AUTO, PARSER_SOUP, PARSER_XHTML
 from constants import NAMESPACES as NS
 from toc import NavPoint, TOC, InvalidEpubException
+from cache import ParseCache
+from fileutil import is_filename, is_file_object, MappedZipFile
 
 import toc as util
 
 
+# Size of chunks images are copied by
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# Size of chunks heads of lazy pages are read by
+HEAD_CHUNK_SIZE = 4 * 1024
+
+# Marks values which are not computed yet (None is a valid value of them)
+_NOT_SET = object()
+
+class SharedFile(object):
+    '''Read-only view of a file object shared with other views, e.g. by ZipFiles read
+    in different threads. Each view has its own position; the file is sought and read
+    under lock, which is common for all the views of the file'''
+
+    def __init__(self, f, lock):
+        self.f = f
+        self.lock = lock
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            with self.lock:
+                self.f.seek(0, 2)
+                offset += self.f.tell()
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        with self.lock:
+            self.f.seek(self.position)
+            data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
 class EpubArchive(object):
     '''Represents an entire epub container'''
 
@@ -25,14 +70,66 @@ class EpubArchive(object):
     _parsed_metadata = None
     _parsed_toc = None
 
-    def __init__(self, basename, use_spine_as_toc=True):
-        self.name = basename
+    def __init__(self, basename, use_spine_as_toc=True, lazy=False, parser_mode=PARSER_AUTO, parse_cache=None,
+                 split_shared_files=True, keep_raw_documents=False, workers=1, stats=None,
+                 keep_pre_whitespace=False, zip_pool=None, use_mmap=False):
+        '''basename is the file name of the archive, an open file object or content of the file
+        as bytearray, memoryview, buffer or mmap, which is read without copying it.
+        A str is always taken as the file name, so content read as str is to be wrapped
+        in buffer() or memoryview() (see fileutil.is_filename).
+        The archive file is closed by close() (or at the end of with statement);
+        non-lazy archive closes it as soon as all the pages are read.
+        If lazy is set, pages are read from the archive and parsed only when
+        their content is accessed for the first time.
+        parser_mode is either PARSER_AUTO or PARSER_SOUP.
+        parse_cache is a ParseCache of files which pages are carved out of one by one
+        (split_shared_files is not set), it might be shared with other archives;
+        by default the archive uses its own one. Files of single pages are not cached.
+        If split_shared_files is set, a file which successive navpoints point to
+        is parsed once and pages for the navpoints are carved out of it.
+        Raw OPF and NCX documents are kept in self.opf and self.toc only if
+        keep_raw_documents is set, parsed ones are always in self.package.
+        If workers is more than 1, pages are parsed by a pool of that many processes.
+        Lazy archive parses each page on its own, so it could not have workers (ValueError is raised).
+        If stats (stats.Stats) is given, stages of processing are recorded in it.
+        If keep_pre_whitespace is set, whitespace of content files having <pre> elements
+        is kept as is rather than normalized.
+        If zip_pool (cache.ZipFilePool) is given, the archive file is taken from it
+        rather than opened, and returned to it on close. The pool might close the file
+        while the archive is open, then it is taken from the pool again when read.
+        If use_mmap is set, the archive file is memory mapped rather than read,
+        it is unmapped when the file is closed'''
+        if lazy and workers > 1:
+            raise ValueError("Pages of lazy archive are not parsed by workers")
+        self.source = basename
+        self.name = basename if is_filename(basename) else getattr(basename, 'name', '<epub>')
+        self.zip_pool = zip_pool if is_filename(basename) else None
+        self.use_mmap = use_mmap
+        self._zip = None
+        # Guards the file object given as basename, which is read through SharedFile views
+        self._source_lock = Lock()
         self.title = None
         self.opf = None
         self.authors = None
         self.toc = None
+        self.package = None
+        self.content_path = None
+        self.file_crcs = {}
+        self.keep_raw_documents = keep_raw_documents
         self.pages = []
         self.use_spine_as_toc = use_spine_as_toc
+        self.lazy = lazy
+        self.parser_mode = parser_mode
+        self.split_shared_files = split_shared_files
+        self.workers = workers
+        self.stats = stats
+        self.keep_pre_whitespace = keep_pre_whitespace
+        # Number of pages parsed by each of the parsers
+        self.parser_counts = {PARSER_XHTML: 0, PARSER_SOUP: 0}
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        # Number of pages with each <title>, see count_page_titles
+        self._title_counts = {}
+        self._title_counted_pages = 0
         self.explode()
 
     def safe_title(self):
@@ -51,13 +148,13 @@ class EpubArchive(object):
           return self.authors[0]
 
     def get_subjects(self):
-        return self._get_metadata(constants.DC_SUBJECT_TAG, self.opf, plural=True) or []
+        return self._get_metadata(constants.DC_SUBJECT_TAG, self.package.opf, plural=True) or []
 
     def get_rights(self):
-        return self._get_metadata(constants.DC_RIGHTS_TAG, self.opf, as_string=True) or ''
+        return self._get_metadata(constants.DC_RIGHTS_TAG, self.package.opf, as_string=True) or ''
 
     def get_language(self):
-        return self._get_metadata(constants.DC_LANGUAGE_TAG, self.opf, as_string=True) or ''
+        return self._get_metadata(constants.DC_LANGUAGE_TAG, self.package.opf, as_string=True) or ''
 
     def get_major_language(self):
         lang = self.get_language()
@@ -71,10 +168,10 @@ class EpubArchive(object):
 
     def get_description(self):
         '''Return dc:description'''
-        return self._get_metadata(constants.DC_DESCRIPTION_TAG, self.opf, as_string=True) or ''
+        return self._get_metadata(constants.DC_DESCRIPTION_TAG, self.package.opf, as_string=True) or ''
 
     def get_publisher(self):
-        return self._get_metadata(constants.DC_PUBLISHER_TAG, self.opf, plural=True) or []
+        return self._get_metadata(constants.DC_PUBLISHER_TAG, self.package.opf, plural=True) or []
 
     def get_toc_items(self):
         t = self.get_toc()
@@ -82,18 +179,87 @@ class EpubArchive(object):
 
     def get_toc(self):
         if not self._parsed_toc:
-            self._parsed_toc = TOC(self.toc, self.opf)
+            self._parsed_toc = TOC(self.package.toc, self.package.opf, stats=self.stats)
         return self._parsed_toc
 
+    def count_page_titles(self, title):
+        '''Returns the number of pages having <title> equal to title.
+        Titles of the pages added since the last call are counted first
+        (just the heads of lazy pages are read and parsed, see EpubPage.title_text)'''
+        for page in self.pages[self._title_counted_pages:]:
+            page_title = page.title_text
+            self._title_counts[page_title] = self._title_counts.get(page_title, 0) + 1
+        self._title_counted_pages = len(self.pages)
+        return self._title_counts.get(title, 0)
+
+    def get_page_crc(self, page):
+        '''Returns CRC-32 of the content file of the page'''
+        return self.file_crcs.get("%s%s" % (self.content_path, page.filename.split("#")[0]))
+
+    def iter_pages(self):
+        '''Yields pages in order of the spine or of navpoints (see use_spine_as_toc).
+        Pages of lazy archive are loaded when they are reached and released as soon as
+        the consumer asks for the next page, so only the current page is kept parsed'''
+        for page in self.pages:
+            yield page
+            page.unload()
+
     def get_last_chapter_read(self, user):
         '''Get the last chapter read by this user.'''
         ua = self.user_archive.filter(user=user, last_chapter_read__isnull=False).order_by('-id')
         if len(ua) > 0:
             return ua[0].last_chapter_read
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Closes the archive file or returns it to zip_pool. Lazy pages which are not
+        loaded could not be loaded afterwards'''
+        if self._zip is not None:
+            if self.zip_pool is not None:
+                self.zip_pool.release(self._zip)
+            else:
+                self._zip.close()
+            self._zip = None
+
+    def _get_zip(self):
+        '''Returns the archive file opened by explode(), taking it from zip_pool again
+        if the pool has closed it to bound the number of open files'''
+        if self._zip is not None and self.zip_pool is not None and not self.zip_pool.is_open(self._zip):
+            self._zip = self.zip_pool.acquire(self.source, self.use_mmap)
+        return self._zip
+
+    def open_zip(self, pooled=True):
+        '''Returns ZipFile of the archive: new one, or one of zip_pool if pooled is set'''
+        source = self.source
+        if is_filename(source):
+            if pooled and self.zip_pool is not None:
+                return self.zip_pool.acquire(source, self.use_mmap)
+            return MappedZipFile(source) if self.use_mmap else ZipFile(source, 'r')
+        if is_file_object(source):
+            return ZipFile(SharedFile(source, self._source_lock), 'r')
+        # cStringIO reads the content through the buffer interface without copying it
+        return ZipFile(StringIO(source), 'r')
+
     def explode(self):
         '''Explodes an epub archive'''
-        z = ZipFile( self.name, 'r' ) # Returns a filehandle
+        self._zip = self.open_zip()
+        try:
+            self._explode(self._zip)
+        except:
+            self.close()
+            raise
+        if not self.lazy:
+            self.close()
+
+    def _explode(self, z):
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
         try:
             container = z.read(self._CONTAINER)
         except KeyError:
@@ -115,25 +281,46 @@ class EpubArchive(object):
         opf_filename = self._get_opf_filename(parsed_container)
 
         content_path = self._get_content_path(opf_filename)
-        self.opf = z.read(opf_filename)
-        parsed_opf = util.xml_from_string(self.opf)
+        opf = z.read(opf_filename)
+        parsed_opf = util.xml_from_string(opf)
 
         items = [i for i in parsed_opf.iterdescendants(tag="{%s}item" % (NS['opf']))]
 
         toc_filename = self._get_toc(parsed_opf, items, content_path)
         try:
-            self.toc = z.read(toc_filename)
+            toc = z.read(toc_filename)
         except KeyError:
             raise InvalidEpubException('TOC file was referenced in OPF, but not found in archive: toc file %s' % toc_filename, archive=self)
 
-        parsed_toc = util.xml_from_string(self.toc)
+        parsed_toc = util.xml_from_string(toc)
+        if self.keep_raw_documents:
+            self.opf = opf
+            self.toc = toc
+        self.package = EpubPackage(opf_filename, parsed_opf, items, toc_filename, parsed_toc)
+        self.content_path = content_path
+        # CRC-32 of the files from the central directory, see get_page_crc
+        self.file_crcs = dict([(info.filename, info.CRC) for info in z.infolist()])
 
         self.authors  = self._get_authors(parsed_opf)
         self.title    = self._get_title(parsed_opf)
+        if stats is not None:
+            stats.add("read_package", time.time() - start)
+            start = time.time()
         if self.use_spine_as_toc:
             self._get_content(z, parsed_opf, parsed_toc, items, content_path)
         else:
             self._get_content_from_nav_points(z, content_path)
+        if stats is not None:
+            stats.add("create_pages", time.time() - start, pages=len(self.pages))
+            start = time.time()
+        if not self.lazy:
+            # Pages are loaded once all of them are created, so that each shared file is parsed once
+            if self.workers > 1:
+                self._load_pages_in_pool()
+            for page in self.pages:
+                page.load()
+            if stats is not None:
+                stats.add("load_pages", time.time() - start)
         #self._get_images(z, items, content_path)
 
 
@@ -186,51 +373,84 @@ class EpubArchive(object):
     def _get_authors(self, opf):
         '''Retrieves a list of authors from the opf file, tagged as dc:creator.  It is acceptable
         to have no author or even an empty dc:creator'''
-        authors = [a.text.strip() for a in opf.findall('.//{%s}%s' % (NS['dc'], constants.DC_CREATOR_TAG)) if a is not None and a.text is not None]
+        authors = get_authors(opf)
         if len(authors) == 0:
             logging.warning('Got empty authors string for book %s' % self.name)
         return authors
 
     def _get_title(self, xml):
         '''Retrieves the title from dc:title in the OPF'''
-        title = xml.xpath('/opf:package/opf:metadata//dc:title/text()', namespaces={ 'opf': NS['opf'],
-                                                                                    'dc': NS['dc']})
-        if len(title) == 0:
+        title = get_title(xml)
+        if title is None:
             raise InvalidEpubException('This ePub document does not have a title.  According to the ePub specification, all documents must have a title.', archive=self)
 
-        return title[0].strip()
+        return title
 
     def _get_images(self, archive, items, content_path):
         '''Images might be in a variety of formats, from JPEG to SVG.  It may also be a video type, though hopefully the content creator included the required fallback.
-        If they are SVG they need to be specially handled as a text type.'''
-        images = []
+        Images are described by EpubImage records, their content is not read (see extract_images)'''
+        self._create_images(list(self._iter_images(archive, items, content_path)))
+
+    def _iter_images(self, archive, items, content_path):
         for item in items:
-            if 'image' in item.get('media-type') or 'video' in item.get('media-type') or 'flash' in item.get('media-type'):
+            media_type = item.get('media-type', '')
+            if 'image' in media_type or 'video' in media_type or 'flash' in media_type:
 
                 href = unquote_plus(item.get('href'))
-
+                archive_filename = "%s%s" % (content_path, href)
                 try:
-                    content = archive.read("%s%s" % (content_path, href))
+                    info = archive.getinfo(archive_filename)
                 except KeyError:
                     logging.warning("Missing image %s; skipping" % href)
                     continue
-                data = {'data': None, 'file': None}
-
-                if item.get('media-type') == constants.SVG_MIMETYPE:
-                    data['file'] = unicode(content, ENC)
-
-                else:
-                    # This is a binary file, like a jpeg
-                    data['data'] = content
-
-                (data['path'], data['filename']) = os.path.split(href)
-                logging.debug('Got path=%s, filename=%s' % (data['path'], data['filename']))
-                data['idref'] = item.get('id')
-                data['content_type'] = item.get('media-type')
-
-                images.append(data)
-
-        self._create_images(images)
+                yield EpubImage(item.get('id'), href, archive_filename, media_type, info.file_size)
+
+    def extract_images(self, sink=None, chunk_size=IMAGE_CHUNK_SIZE):
+        '''Yields EpubImage for every image (or video, flash) item of the manifest.
+        If sink is given, the image is copied to it chunk by chunk before being yielded,
+        so that no image is held in memory as a whole. sink is either a directory, where
+        images are written by their paths relative to the OPF file (EpubImage.output is set
+        to the file name), or a function taking EpubImage and returning a file object to write to,
+        which is closed afterwards.
+        The archive is opened anew (a file object is read through its own SharedFile view),
+        so images might be extracted in another thread while pages are processed
+        (see extract_images_in_thread)'''
+        z = self.open_zip(pooled=False)
+        try:
+            for image in self._iter_images(z, self.package.items, self.content_path):
+                if sink is not None:
+                    self._copy_image(z, image, sink, chunk_size)
+                yield image
+        finally:
+            z.close()
+
+    def extract_images_in_thread(self, sink, chunk_size=IMAGE_CHUNK_SIZE):
+        '''Starts extraction of images to sink in a thread, returns the ImageExtractor thread'''
+        extractor = ImageExtractor(self, sink, chunk_size)
+        extractor.start()
+        return extractor
+
+    def _copy_image(self, archive, image, sink, chunk_size):
+        if callable(sink):
+            output = sink(image)
+        else:
+            filename = os.path.normpath(image.href)
+            if os.path.isabs(filename) or filename.split(os.sep)[0] == os.pardir:
+                logging.warning("Image %s is outside of the content directory; skipping" % image.href)
+                return
+            image.output = os.path.join(sink, filename)
+            directory = os.path.dirname(image.output)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            output = open(image.output, "wb")
+        try:
+            source = archive.open(image.archive_filename)
+            try:
+                shutil.copyfileobj(source, output, chunk_size)
+            finally:
+                source.close()
+        finally:
+            output.close()
 
     def _create_images(self, images):
         pass
@@ -255,41 +475,44 @@ class EpubArchive(object):
     def _get_content_from_nav_points(self, archive, content_path):
         toc_tree = self.get_toc().tree
         page_for_navpoint = {}
+        shared_content = None
         for i in range(len(toc_tree)):
             current_nav_point = toc_tree[i]
             previous_anchor = None
             next_anchor = None
             if i != 0:
                 previous_nav_point = toc_tree[i-1]
-                if current_nav_point.href().split("#")[0] == previous_nav_point.href().split("#")[0]:
-                    previous_anchor = {"title": previous_nav_point.title()}
-                    try:
-                        previous_anchor["id"] = previous_nav_point.href().split("#")[1]
-                    except IndexError:
-                        previous_anchor["id"] = None
+                if current_nav_point.href_file == previous_nav_point.href_file:
+                    previous_anchor = {"title": previous_nav_point.title(), "id": previous_nav_point.href_fragment}
             if i != len(toc_tree)-1:
                 next_nav_point = toc_tree[i+1]
-                if current_nav_point.href().split("#")[0] == next_nav_point.href().split("#")[0]:
-                    next_anchor = {"id": next_nav_point.href().split("#")[1], "title": next_nav_point.title()}
+                if current_nav_point.href_file == next_nav_point.href_file:
+                    next_anchor = {"id": next_nav_point.href_fragment, "title": next_nav_point.title()}
 
-            filename = "%s%s" %(content_path, current_nav_point.href().split("#")[0])
-            try:
-                content = archive.read(filename)
-            except Exception:
-                raise InvalidEpubException(
-                    'Could not find file %s in archive even though it was listed in the NCX file' %filename,
-                    archive=self
-                )
-
-            page = self._create_page(
-                current_nav_point.title(),
-                None,
-                current_nav_point.href(),
-                content,
-                self,
-                current_nav_point.order(),
-                previous_anchor,
-                next_anchor
+            if previous_anchor is None:
+                filename = "%s%s" %(content_path, current_nav_point.href_file)
+                try:
+                    content = self._read_content_file(archive, filename)
+                except Exception:
+                    raise InvalidEpubException(
+                        'Could not find file %s in archive even though it was listed in the NCX file' %filename,
+                        archive=self
+                    )
+                shared_content = None
+                if self.split_shared_files and next_anchor is not None:
+                    shared_content = SharedContentFile(self, content)
+
+            page = EpubPage(
+                title=current_nav_point.title(),
+                idref=None,
+                filename=current_nav_point.href(),
+                file_content=content,
+                archive=self,
+                order=current_nav_point.order(),
+                previous_anchor=previous_anchor,
+                next_anchor=next_anchor,
+                lazy=True,
+                shared_content=shared_content
             )
             self.pages.append(page)
             page.bind_to_parent(page_for_navpoint.get(current_nav_point.parent))
@@ -312,8 +535,7 @@ class EpubArchive(object):
 
         for nav in navs:
             n = NavPoint(nav, doc_title=self.title)
-            href = n.href()
-            filename = href.split('#')[0]
+            filename = n.href_file
             if nav_map.has_key(filename):
                 pass
                 # Skip this item so we don't overwrite with a new navpoint
@@ -333,7 +555,7 @@ class EpubArchive(object):
                 href = item_map[idref]
                 filename = '%s%s' % (content_path, href)
                 try:
-                    content = archive.read(filename)
+                    content = self._read_content_file(archive, filename)
                 except Exception:
                     raise InvalidEpubException('Could not find file %s in archive even though it was listed in the OPF file' % filename,
                                                archive=self)
@@ -361,6 +583,49 @@ class EpubArchive(object):
                 ))
 
 
+    def _read_content_file(self, archive, filename):
+        '''Return content of the file. Lazy archive only checks that the file exists
+        and returns a callable which reads it on the first access'''
+        if not self.lazy:
+            return self._read_file(archive, filename)
+        archive.getinfo(filename)
+        return ArchiveFile(self, filename)
+
+    def _read_file(self, archive, filename):
+        if archive is None:
+            raise ValueError("Archive %s is closed" % self.name)
+        if self.stats is None:
+            return archive.read(filename)
+        start = time.time()
+        content = archive.read(filename)
+        self.stats.add("zip_read", time.time() - start, bytes=len(content))
+        return content
+
+    def _read_head(self, archive, filename):
+        '''Returns the beginning of the file up to the end of its <head> (the whole file
+        if it has no head), the rest of the file is not decompressed'''
+        if archive is None:
+            raise ValueError("Archive %s is closed" % self.name)
+        start = time.time()
+        head = ''
+        f = archive.open(filename)
+        try:
+            while True:
+                chunk = f.read(HEAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                head += chunk
+                # The end of the head might be split between chunks
+                head_end = HEAD_END.search(head, max(0, len(head) - len(chunk) - 64))
+                if head_end is not None:
+                    head = head[:head_end.end()]
+                    break
+        finally:
+            f.close()
+        if self.stats is not None:
+            self.stats.add("zip_read_head", time.time() - start, bytes=len(head))
+        return head
+
     def _create_page(self, title, idref, filename, file_content, archive, order, previous_anchor=None, next_anchor=None):
         '''Create an HTML page and associate it with the archive'''
         return EpubPage(
@@ -371,74 +636,366 @@ class EpubArchive(object):
                         archive=archive,
                         order=order,
                         previous_anchor=previous_anchor,
-                        next_anchor=next_anchor
+                        next_anchor=next_anchor,
+                        lazy=True
         )
 
+    def _load_pages_in_pool(self):
+        '''Parses content of all the pages by a pool of self.workers processes.
+        Raw content of each file is sent to a worker (once for the pages carved out of
+        a shared file), trees of the pages are sent back dumped by dump_tree'''
+        jobs = []
+        job_pages = []
+        for page in self.pages:
+            shared_content = page.shared_content
+            if shared_content is not None:
+                if job_pages and job_pages[-1][0].shared_content is shared_content:
+                    job_pages[-1].append(page)
+                    jobs[-1][3].append(page.page_range_anchors())
+                    continue
+                file_content = shared_content._file_content
+            else:
+                file_content = page._file_content
+            if callable(file_content):
+                file_content = file_content()
+            jobs.append((file_content, self.parser_mode, self.keep_pre_whitespace, [page.page_range_anchors()]))
+            job_pages.append([page])
+        pool = Pool(self.workers)
+        try:
+            results = pool.map(parse_page_ranges, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for (pages, (page_content, parser_used, dumped_pages)) in zip(job_pages, results):
+            for (page, dumped) in zip(pages, dumped_pages):
+                page.set_parsed_content(page_content, load_tree(dumped), parser_used)
+
 
     def _get_metadata(self, metadata_tag, opf, plural=False, as_string=False, as_list=False):
         '''Returns a metadata item's text content by tag name, or a list if mulitple names match.
-        If as_string is set to True, then always return a comma-delimited string.'''
+        If as_string is set to True, then always return a comma-delimited string.
+        opf might be either parsed or raw OPF document'''
         if self._parsed_metadata is None:
             try:
-                self._parsed_metadata = util.xml_from_string(opf)
+                self._parsed_metadata = util.parsed_xml(opf)
             except InvalidEpubException:
                 return None
-        text = []
-        alltext = self._parsed_metadata.findall('.//{%s}%s' % (NS['dc'], metadata_tag))
-        if as_list:
-            return [t.text.strip() for t in alltext if t.text]
-        if as_string:
-            return ', '.join([t.text.strip() for t in alltext if t.text])
-        for t in alltext:
-            if t.text is not None:
-                text.append(t.text)
-        if len(text) == 1:
-            t = (text[0], ) if plural else text[0]
-            return t
-        return text
+        return get_metadata(self._parsed_metadata, metadata_tag, plural, as_string, as_list)
 
     def __unicode__(self):
         return u'%s by %s (%s)' % (self.title, self.author, self.name)
 
 
-def normalize_text(text_content):
+# Metadata of OPF document, used by EpubArchive and metadata.read_metadata
+
+def get_title(opf):
+    '''Returns dc:title of parsed OPF document, or None'''
+    title = opf.xpath('/opf:package/opf:metadata//dc:title/text()', namespaces={ 'opf': NS['opf'],
+                                                                                'dc': NS['dc']})
+    if len(title) == 0:
+        return None
+    return title[0].strip()
+
+def get_authors(opf):
+    '''Returns list of dc:creator of parsed OPF document'''
+    return [a.text.strip() for a in opf.findall('.//{%s}%s' % (NS['dc'], constants.DC_CREATOR_TAG)) if a is not None and a.text is not None]
+
+def get_metadata(opf, metadata_tag, plural=False, as_string=False, as_list=False):
+    '''Returns text of metadata item of parsed OPF document, see EpubArchive._get_metadata'''
+    text = []
+    alltext = opf.findall('.//{%s}%s' % (NS['dc'], metadata_tag))
+    if as_list:
+        return [t.text.strip() for t in alltext if t.text]
+    if as_string:
+        return ', '.join([t.text.strip() for t in alltext if t.text])
+    for t in alltext:
+        if t.text is not None:
+            text.append(t.text)
+    if len(text) == 1:
+        t = (text[0], ) if plural else text[0]
+        return t
+    return text
+
+
+class EpubPackage(object):
+    '''Parsed OPF and NCX documents of an epub archive. They are parsed once in
+    EpubArchive.explode and shared by TOC, metadata accessors and content extraction'''
+
+    def __init__(self, opf_filename, opf, items, toc_filename, toc):
+        self.opf_filename = opf_filename
+        self.opf = opf
+        self.items = items
+        self.toc_filename = toc_filename
+        self.toc = toc
+
+
+class ArchiveFile(object):
+    '''Content file of lazy archive, which is read when it is called.
+    read_head() reads just the beginning of the file up to the end of its <head>'''
+
+    def __init__(self, archive, filename):
+        self.archive = archive
+        self.filename = filename
+
+    def __call__(self):
+        return self.archive._read_file(self.archive._get_zip(), self.filename)
+
+    def read_head(self):
+        return self.archive._read_head(self.archive._get_zip(), self.filename)
+
+
+class EpubImage(object):
+    '''Image (or other binary) item of the manifest. Its content is not kept: it is copied
+    by EpubArchive.extract_images, output is the file it was copied to, if any'''
+
+    def __init__(self, idref, href, archive_filename, content_type, size):
+        self.idref = idref
+        self.href = href
+        (self.path, self.filename) = os.path.split(href)
+        self.archive_filename = archive_filename
+        self.content_type = content_type
+        self.size = size
+        self.output = None
+
+
+class ImageExtractor(Thread):
+    '''Thread extracting images of the archive, see EpubArchive.extract_images.
+    Once it is joined, images holds EpubImage records of extracted images and error
+    the exception extraction failed with, if any'''
+
+    def __init__(self, archive, sink, chunk_size=IMAGE_CHUNK_SIZE):
+        Thread.__init__(self)
+        self.daemon = True
+        self.archive = archive
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.images = []
+        self.error = None
+
+    def run(self):
+        try:
+            for image in self.archive.extract_images(self.sink, self.chunk_size):
+                self.images.append(image)
+        except Exception, e:
+            logging.error("Failed to extract images of %s: %s" % (self.archive.name, e))
+            self.error = e
+
+
+def as_unicode(text):
+    """
+    Returns text of lxml (str if it is ASCII, unicode otherwise) as unicode
+    """
+    if text is None or isinstance(text, unicode):
+        return text
+    return unicode(text, "ascii")
+
+def normalize_text(text_content, keep_whitespace=False):
     """
-    Replaces "&nbsp;" with spaces and subtitutes multiple spaces with single one
+    Replaces "&nbsp;" with spaces and subtitutes multiple spaces with single one.
+    "&nbsp;" is whitespace for split(), so it is not replaced separately.
+    If keep_whitespace is set, just "&nbsp;" is replaced.
+    split() and join() collapse whitespace twice as fast as a single re.sub() pass
+    (which builds the list of pieces as well), so they are kept
     """
     if not isinstance(text_content, unicode):
         text_content = unicode(text_content, "UTF-8")
-    return " ".join(text_content.replace(u"\u00A0", " ").split())
+    if keep_whitespace:
+        return text_content.replace(u"\u00A0", u" ")
+    return u" ".join(text_content.split())
+
+PRE_TAG = re.compile(r'<pre[\s>]', re.IGNORECASE)
+
+def normalize_content(file_content, keep_pre_whitespace=False):
+    """
+    Normalizes raw content file with normalize_text. If keep_pre_whitespace is set,
+    whitespace of files having <pre> elements is kept
+    """
+    return normalize_text(file_content, keep_pre_whitespace and PRE_TAG.search(file_content) is not None)
+
+def parse_xhtml(page_content):
+    """
+    Parses well-formed XHTML with libxml2. Result looks like the one of soupparser:
+    elements are not namespaced and their attributes are sorted.
+    Raises etree.XMLSyntaxError if page_content is not well-formed
+    """
+    html = etree.fromstring(page_content.encode(ENC), lxml.html.XHTMLParser(encoding=ENC, no_network=True))
+    lxml.html.xhtml_to_html(html)
+    etree.cleanup_namespaces(html)
+    for elem in html.iter(tag=etree.Element):
+        if len(elem.attrib) > 1:
+            attributes = sorted(elem.attrib.items())
+            elem.attrib.clear()
+            elem.attrib.update(attributes)
+    return html
+
+class _NullTarget(object):
+    """Parser target building nothing, see is_well_formed"""
+    def start(self, tag, attrib):
+        pass
+    def end(self, tag):
+        pass
+    def data(self, data):
+        pass
+    def comment(self, text):
+        pass
+    def close(self):
+        return None
+
+def is_well_formed(page_content):
+    """
+    Tells whether page_content is parsed by parse_xhtml, scanning it without building the tree
+    """
+    parser = lxml.html.XHTMLParser(target=_NullTarget(), encoding=ENC, no_network=True)
+    try:
+        etree.fromstring(page_content.encode(ENC), parser)
+    except etree.XMLSyntaxError:
+        return False
+    return True
+
+def parse_html(page_content, parser_mode=PARSER_AUTO):
+    """
+    Returns tuple (parsed page_content, name of parser used)
+    """
+    if parser_mode == PARSER_AUTO:
+        try:
+            return (parse_xhtml(page_content), PARSER_XHTML)
+        except etree.XMLSyntaxError:
+            logging.debug('Was not valid XHTML; trying with BeautifulSoup')
+    import lxml.html.soupparser
+    return (lxml.html.soupparser.fromstring(page_content), PARSER_SOUP)
+
+HEAD_END = re.compile(r'</head\s*>', re.IGNORECASE)
+
+def parse_head(file_content, parser_mode=PARSER_AUTO, keep_pre_whitespace=False, read_file=None):
+    """
+    Returns <title> element of raw file_content parsing just its head,
+    or None if there is no head or no title in it. Just the head is normalized
+    (see normalize_content), as the title is the same as in the whole normalized file.
+    file_content might be just the beginning of the file up to the end of its head
+    (see ArchiveFile.read_head), then read_file is a callable returning the whole file.
+    In PARSER_AUTO mode the head is parsed as XHTML if it is well-formed, the parser of
+    the whole file is chosen when the file is loaded. The parsers give the same title
+    unless it has child nodes (e.g. a comment), just then the whole file is checked
+    to be well-formed (see is_well_formed) to take the title its parser gives
+    """
+    head_end = HEAD_END.search(file_content)
+    if head_end is None:
+        return None
+    keep_whitespace = keep_pre_whitespace and PRE_TAG.search(file_content) is not None
+    head = normalize_text(file_content[:head_end.end()], keep_whitespace) + '</html>'
+    html, parser_used = parse_html(head, parser_mode)
+    title = html.find('.//title')
+    if title is not None and len(title) and parser_used == PARSER_XHTML:
+        if read_file is not None:
+            file_content = read_file()
+        if not is_well_formed(normalize_text(file_content, keep_whitespace)):
+            title = parse_html(head, PARSER_SOUP)[0].find('.//title')
+    return title
+
+def parse_head_title(file_content, parser_mode=PARSER_AUTO, keep_pre_whitespace=False):
+    """
+    Returns <title> element of file_content, the raw content or a callable returning it,
+    see parse_head. Just the head of ArchiveFile is read, unless whitespace of <pre>
+    elements might be kept (then the title depends on the whole file)
+    """
+    if not callable(file_content):
+        return parse_head(file_content, parser_mode, keep_pre_whitespace)
+    if keep_pre_whitespace or not isinstance(file_content, ArchiveFile):
+        return parse_head(file_content(), parser_mode, keep_pre_whitespace)
+    return parse_head(file_content.read_head(), parser_mode, keep_pre_whitespace, file_content)
+
+def count_elements(root):
+    count = 0
+    for elem in root.iter():
+        count += 1
+    return count
 
 def get_sealing_element(child_elem):
-    while len([elem for elem in child_elem.getparent().iterchildren()]) == 1:
+    while len(child_elem.getparent()) == 1:
         child_elem = child_elem.getparent()
     return child_elem
 
-def find_anchor_by_id_or_text(root_elem, element_id, text_content):
+class AnchorIndex(object):
     """
-    Find element with given id or text content under root_elem element
+    Index of a parsed content file for find_bounding_elements: elements of body by id,
+    <a> elements of the document by their text and headings of body in document order.
+    It is built once per parsed file and used for all the pages carved out of it
     """
-    res = None
-    res = root_elem.cssselect("#%s" %element_id)
-    if len(res) == 1:
-        return get_sealing_element(res[0])
-    res = root_elem.xpath('//a[text()="%s"]' %text_content)
-    if len(res) == 1:
-        return get_sealing_element(res[0])
 
-def find_bounding_elements(root_elem, previous_anchor, current_anchor, next_anchor):
+    _HEADINGS = etree.XPath("|".join(["descendant::h%d" % level for level in range(1, 7)]))
+
+    def __init__(self, body):
+        self.body = body
+        # None is kept for ids and texts of several elements, as they identify nothing
+        self._ids = {}
+        for elem in body.xpath("descendant-or-self::*[@id]"):
+            element_id = elem.get("id")
+            self._ids[element_id] = None if element_id in self._ids else elem
+        # Built when the first anchor is not found by id
+        self._links = None
+        self._headings = None
+
+    def find_anchor(self, element_id, text_content):
+        """
+        Returns element with given id, or <a> element with given text, or None
+        """
+        elem = self._ids.get(element_id)
+        if elem is None:
+            if self._links is None:
+                self._links = {}
+                for link in self.body.xpath("//a"):
+                    for text in set([link.text] + [child.tail for child in link]):
+                        if text is not None:
+                            self._links[text] = None if text in self._links else link
+            elem = self._links.get(text_content)
+        if elem is not None:
+            return get_sealing_element(elem)
+
+    @property
+    def headings(self):
+        """
+        h1 - h6 elements of body in document order
+        """
+        if self._headings is None:
+            self._headings = self._HEADINGS(self.body)
+            self._headings_text = [el.text_content() for el in self._headings]
+            self._heading_positions = {}
+            for (i, text) in enumerate(self._headings_text):
+                self._heading_positions.setdefault(text, []).append(i)
+        return self._headings
+
+    def find_headings(self, expected_headings):
+        """
+        Returns position in headings of the first sub-sequence of headings having
+        expected_headings texts, or None
+        """
+        headings = self.headings
+        if not expected_headings:
+            return 0 if headings else None
+        for i in self._heading_positions.get(expected_headings[0], ()):
+            if self._headings_text[i:i+len(expected_headings)] == expected_headings:
+                return i
+        return None
+
+def find_bounding_elements(root_elem, previous_anchor, current_anchor, next_anchor, stats=None, page=None, index=None):
     """
     Find start and end elements of area enclosed by headings from current_anchor and next_anchor
     previous_anchor = None or {"id": "some_id_1", "title": "Some Title 1"}
     current_anchor = None or {"id": "some_id_2", "title": "Some Title 2"}
     next_anchor = None or {"id": "some_id_3", "title": "Some Title 3"}
+    index is AnchorIndex of root_elem, it is built if not given.
+    If anchors are not found by id or text, headings are scanned, which is recorded
+    in stats for the page if stats is given
     """
-    start_elem = find_anchor_by_id_or_text(root_elem, current_anchor["id"], current_anchor["title"]) if current_anchor else None
-    end_elem = find_anchor_by_id_or_text(root_elem, next_anchor["id"], next_anchor["title"]) if next_anchor else None
+    if index is None:
+        index = AnchorIndex(root_elem)
+    start_elem = index.find_anchor(current_anchor["id"], current_anchor["title"]) if current_anchor else None
+    end_elem = index.find_anchor(next_anchor["id"], next_anchor["title"]) if next_anchor else None
     if (start_elem is not None) and ((end_elem is not None) or (next_anchor is None)):
         return (start_elem, end_elem)
-    heading_elements = [el for el in root_elem.iterdescendants() if el.tag in ("h1", "h2", "h3", "h4", "h5", "h6")]
-    headings_text = [el.text_content() for el in heading_elements]
+    heading_elements = index.headings
+    if stats is not None:
+        stats.add("heading_scan", page=page, headings=len(heading_elements))
     expected_headings = []
     if previous_anchor is not None:
         expected_headings.append(previous_anchor["title"])
@@ -447,24 +1004,318 @@ def find_bounding_elements(root_elem, previous_anchor, current_anchor, next_anch
     if next_anchor is not None:
         expected_headings.append(next_anchor["title"])
     # Finding sub-sequence of headings matching expected_headings
-    for i in range(len(heading_elements)):
-        if headings_text[i:i+len(expected_headings)] == expected_headings:
-            current_index = i - 1 if (current_anchor is None) else i if previous_anchor is None else i+1
-            start_elem = None if (current_anchor is None) else heading_elements[current_index]
-            end_elem = heading_elements[current_index + 1] if next_anchor is not None else None
-            return (start_elem, end_elem)
+    i = index.find_headings(expected_headings)
+    if i is not None:
+        current_index = i - 1 if (current_anchor is None) else i if previous_anchor is None else i+1
+        start_elem = None if (current_anchor is None) else heading_elements[current_index]
+        end_elem = heading_elements[current_index + 1] if next_anchor is not None else None
+        return (start_elem, end_elem)
     raise Exception("Cannot find element for anchor with id '%s' and title '%s'. Headings: '%s'" %(current_anchor["id"], current_anchor["title"], heading_elements))
 
 
+def prune_page_range(body, start_elem, end_elem):
+    """
+    Removes elements of body which are outside of area between start_elem and end_elem.
+    Ancestors of start_elem are kept, elements outside of the area which are not
+    children of body are emptied rather than removed.
+    """
+    start_ancestors = set() if start_elem is None else set(start_elem.iterancestors())
+    elements_to_remove = []
+    within_start_and_end_elem = True if start_elem is None else False
+    for elem in body.iterdescendants():
+        if elem == start_elem:
+            within_start_and_end_elem = True
+        elif elem == end_elem:
+            within_start_and_end_elem = False
+        if not within_start_and_end_elem and elem not in start_ancestors:
+            elements_to_remove.append(elem)
+    for elem in elements_to_remove:
+        # Descendants of removed elements are already detached by clear()
+        if elem.getparent() is None:
+            continue
+        is_body_child = elem.getparent() is body
+        elem.clear()
+        if is_body_child:
+            body.remove(elem)
+
+def index_positions(root):
+    """
+    Returns dict {element: (position of element in document order, position of its last descendant)}
+    for all nodes under root, root included
+    """
+    nodes = list(root.iter())
+    positions = {}
+    for pos in xrange(len(nodes) - 1, -1, -1):
+        elem = nodes[pos]
+        positions[elem] = (pos, positions[elem[-1]][1] if len(elem) else pos)
+    return positions
+
+def copy_page_range(root, body, start_elem, end_elem, positions):
+    """
+    Returns copy of document with root element, pruned the same way prune_page_range
+    prunes the body. Only parts of the tree which are kept get copied.
+    positions is the result of index_positions(root).
+    """
+    def contains(elem, pos):
+        first, last = positions[elem]
+        return first < pos <= last
+
+    body_pos = positions[body][0]
+    keep_nothing = False
+    start = None if start_elem is None else positions[start_elem][0]
+    end = None if end_elem is None else positions[end_elem][0]
+    if start is not None and not contains(body, start):
+        # start_elem is never reached, so nothing in body is kept
+        keep_nothing = True
+    if end is not None and (not contains(body, end) or (start is not None and end <= start)):
+        # end_elem is not reached after start_elem, so everything after start_elem is kept
+        end = None
+
+    def is_kept(elem):
+        pos = positions[elem][0]
+        if start is not None and pos < start and not contains(elem, start):
+            return False
+        return end is None or pos < end
+
+    def body_child(elem):
+        while elem.getparent() is not body:
+            elem = elem.getparent()
+        return elem
+
+    def body_children():
+        if keep_nothing or len(body) == 0:
+            return
+        child = body[0] if start is None else body_child(start_elem)
+        last_child = None if end is None else body_child(end_elem)
+        yield child
+        if child is last_child:
+            return
+        for child in child.itersiblings():
+            yield child
+            if child is last_child:
+                return
+
+    def empty_copy(elem, parent_copy):
+        if isinstance(elem.tag, basestring):
+            return parent_copy.makeelement(elem.tag)
+        elem_copy = deepcopy(elem)
+        elem_copy.clear()
+        return elem_copy
+
+    def copy_tree(elem, parent_copy=None):
+        # New elements are created in the document of the copy, so that it does not
+        # hold the original document in memory
+        if parent_copy is None:
+            elem_copy = lxml.html.html_parser.makeelement(elem.tag, elem.attrib)
+        else:
+            elem_copy = parent_copy.makeelement(elem.tag, elem.attrib)
+        elem_copy.text = elem.text
+        elem_copy.tail = elem.tail
+        in_body = elem is body or contains(body, positions[elem][0])
+        for child in (body_children() if elem is body else elem.iterchildren()):
+            if not in_body:
+                if child is body or contains(child, body_pos):
+                    elem_copy.append(copy_tree(child, elem_copy))
+                else:
+                    elem_copy.append(deepcopy(child))
+            elif not is_kept(child):
+                if elem is not body:
+                    elem_copy.append(empty_copy(child, elem_copy))
+            elif (start is not None and contains(child, start)) or (end is not None and contains(child, end)):
+                elem_copy.append(copy_tree(child, elem_copy))
+            else:
+                elem_copy.append(deepcopy(child))
+        return elem_copy
+
+    return copy_tree(root)
+
+
+# Node types of dumped trees besides elements, see dump_tree
+COMMENT_NODE = 0
+PI_NODE = 1
+
+def parse_page_ranges(job):
+    """
+    Parses the content file and returns the pages carved out of it dumped by dump_tree.
+    job is a tuple (raw file content, parser mode, keep_pre_whitespace, list of page_range_anchors of the pages).
+    Returns tuple (normalized content, name of parser used, list of dumped pages).
+    Runs in worker processes, see EpubArchive._load_pages_in_pool
+    """
+    (file_content, parser_mode, keep_pre_whitespace, pages_anchors) = job
+    page_content = normalize_content(file_content, keep_pre_whitespace)
+    html, parser_used = parse_html(page_content, parser_mode)
+    body = html.find('.//body')
+    if body is None:
+        raise UnknownContentException()
+    if len(pages_anchors) == 1:
+        if pages_anchors[0] is not None:
+            start_elem, end_elem = find_bounding_elements(body, *pages_anchors[0])
+            prune_page_range(body, start_elem, end_elem)
+        pages = [html]
+    else:
+        positions = index_positions(html)
+        index = AnchorIndex(body)
+        pages = []
+        for anchors in pages_anchors:
+            start_elem, end_elem = find_bounding_elements(body, *anchors, index=index)
+            pages.append(copy_page_range(html, body, start_elem, end_elem, positions))
+    return (page_content, parser_used, [dump_tree(page) for page in pages])
+
+def dump_tree(elem):
+    """
+    Returns the tree as nested tuples (tag, attributes, text, tail, children), which unlike
+    elements could be pickled. Comments and processing instructions (soupparser keeps
+    XML declaration as one) are tuples (etree.Comment, text, tail) and
+    (etree.ProcessingInstruction, target, text, tail)
+    """
+    if elem.tag is etree.Comment:
+        return (COMMENT_NODE, elem.text, elem.tail)
+    if elem.tag is etree.ProcessingInstruction:
+        return (PI_NODE, elem.target, elem.text, elem.tail)
+    return (elem.tag, elem.items(), elem.text, elem.tail, [dump_tree(child) for child in elem])
+
+def load_tree(data, parent=None):
+    """
+    Builds the tree dumped by dump_tree and appends it to parent (HtmlElement) if given
+    """
+    if data[0] == COMMENT_NODE:
+        elem = etree.Comment(data[1])
+        elem.tail = data[2]
+    elif data[0] == PI_NODE:
+        elem = etree.ProcessingInstruction(data[1], data[2])
+        elem.tail = data[3]
+    else:
+        (tag, attributes, text, tail, children) = data
+        if parent is None:
+            elem = lxml.html.html_parser.makeelement(tag)
+        else:
+            elem = parent.makeelement(tag)
+        for (name, value) in attributes:
+            elem.set(name, value)
+        elem.text = text
+        elem.tail = tail
+    if parent is not None:
+        parent.append(elem)
+    if data[0] not in (COMMENT_NODE, PI_NODE):
+        for child in children:
+            load_tree(child, elem)
+    return elem
+
+
+class SharedContentFile(object):
+    """
+    Content file which several successive navpoints point to. The file is parsed once,
+    and each page gets a copy of just its own part of the tree.
+    """
+
+    def __init__(self, archive, file_content):
+        """file_content is either the raw content or a callable returning it"""
+        self.archive = archive
+        self.page_content = None
+        self.parser_used = None
+        self._file_content = file_content
+        self._html = None
+        self._positions = None
+        self._index = None
+        self._head_title_tag = _NOT_SET
+        self._pages_left = 0
+
+    def add_page(self, page):
+        self._pages_left += 1
+
+    def remove_page(self, page):
+        """
+        Tells that the page is not going to be carved out of the file (see
+        EpubPage.release_shared_content), which is released if it was the last one
+        """
+        self._pages_left -= 1
+        if self._pages_left <= 0:
+            self._release()
+
+    def _release(self):
+        self.page_content = None
+        self._html = None
+        self._positions = None
+        self._index = None
+        # <title> of the released tree would keep it in memory
+        self._head_title_tag = _NOT_SET
+
+    def page_tree(self, page):
+        """
+        Returns parsed content of the page. Parsed file is released as soon as
+        all the pages are carved out of it.
+        """
+        stats = self.archive.stats
+        if self._html is None:
+            file_content = self._file_content
+            if callable(file_content):
+                file_content = file_content()
+            else:
+                self._file_content = None
+            self.page_content = page.normalize_text(file_content)
+            self._html, self.parser_used = page.parse_html(self.page_content)
+            self._positions = index_positions(self._html)
+        body = self._html.find('.//body')
+        if body is None:
+            raise UnknownContentException()
+        if self._index is None:
+            self._index = AnchorIndex(body)
+        start_elem, end_elem = page.find_bounding_elements(body, self._index)
+        if stats is not None:
+            start = time.time()
+        html = copy_page_range(self._html, body, start_elem, end_elem, self._positions)
+        if stats is not None:
+            stats.add("copy_page_range", time.time() - start, page=page)
+        page_content = self.page_content
+        page.parser_used = self.parser_used
+        self.archive.parser_counts[self.parser_used] += 1
+        # Pages of lazy archive could be loaded again after they are unloaded,
+        # then the file is parsed again
+        self._pages_left -= 1
+        if self._pages_left <= 0:
+            self._release()
+        return (page_content, html)
+
+    @property
+    def reloadable(self):
+        return callable(self._file_content)
+
+    def head_title_tag(self):
+        """
+        Returns <title> element of the file parsing just its head, see parse_head
+        """
+        if self._head_title_tag is _NOT_SET:
+            if self._html is not None:
+                self._head_title_tag = self._html.find('.//title')
+            else:
+                self._head_title_tag = parse_head_title(self._file_content, self.archive.parser_mode,
+                                                        self.archive.keep_pre_whitespace)
+        return self._head_title_tag
+
 
 class EpubPage(object):
     '''Usually an individual page in the ebook.'''
     
-    def __init__(self, title, idref, filename, file_content, archive, order, previous_anchor = None, next_anchor = None):
+    def __init__(self, title, idref, filename, file_content, archive, order, previous_anchor = None, next_anchor = None, lazy = False, shared_content = None):
+        '''file_content is either the raw page content or a callable returning it.
+        Lazy page is parsed only when its content is accessed for the first time.
+        If shared_content (SharedContentFile) is given, the page is carved out of it
+        and file_content is ignored'''
         self.title_in_toc = title
         self.idref    = idref
         self.filename = filename
-        self.page_content = normalize_text(file_content)
+        self._file_content = file_content
+        self._page_content = None
+        self._page_content_parsed = None
+        self._title_tag = None
+        self._sections = None
+        self._title_text = _NOT_SET
+        self._sole_section_title = _NOT_SET
+        self._page_title = _NOT_SET
+        self.parser_used = None
+        self.shared_content = shared_content
+        if shared_content is not None:
+            shared_content.add_page(self)
         self.archive  = archive
         self.order    = order or 1
         self.current_anchor = None
@@ -483,62 +1334,194 @@ class EpubPage(object):
                 self.current_anchor["id"] = self.filename.split("#")[1]
             except IndexError:
                 self.current_anchor["id"] = None
-        self.page_content_parsed = self.parse_page_content(self.page_content)
-        self.title_tag = self.page_content_parsed.find('.//title')
-        self.sections = []
         self.children_pages = []
+        if not lazy:
+            self.load()
+
+    def load(self):
+        '''Reads and parses page content unless it is done already'''
+        if self._page_content_parsed is not None:
+            return
+        if self.shared_content is not None:
+            self._page_content, self._page_content_parsed = self.shared_content.page_tree(self)
+        else:
+            file_content = self._file_content
+            if callable(file_content):
+                file_content = file_content()
+            self._page_content = self.normalize_text(file_content)
+            self._page_content_parsed = self.parse_page_content(self._page_content)
+        self._content_loaded()
+
+    @property
+    def stats(self):
+        return self.archive.stats if self.archive is not None else None
+
+    def parse_options(self):
+        """
+        Returns tuple (parser mode, keep_pre_whitespace) of the archive
+        """
+        if self.archive is None:
+            return (PARSER_AUTO, False)
+        return (self.archive.parser_mode, self.archive.keep_pre_whitespace)
+
+    def normalize_text(self, file_content):
+        keep_pre_whitespace = self.parse_options()[1]
+        stats = self.stats
+        if stats is None:
+            return normalize_content(file_content, keep_pre_whitespace)
+        start = time.time()
+        page_content = normalize_content(file_content, keep_pre_whitespace)
+        stats.add("normalize_text", time.time() - start, page=self, characters=len(page_content))
+        return page_content
+
+    def parse_html(self, page_content):
+        """
+        Returns tuple (parsed page_content, name of parser used)
+        """
+        parser_mode = self.parse_options()[0]
+        stats = self.stats
+        if stats is None:
+            return parse_html(page_content, parser_mode)
+        start = time.time()
+        (html, parser_used) = parse_html(page_content, parser_mode)
+        stats.add("parse", time.time() - start, page=self, elements=count_elements(html), **{parser_used: 1})
+        return (html, parser_used)
+
+    def set_parsed_content(self, page_content, page_content_parsed, parser_used):
+        '''Sets the content parsed elsewhere (see EpubArchive._load_pages_in_pool)'''
+        self._page_content = page_content
+        self._page_content_parsed = page_content_parsed
+        self.parser_used = parser_used
+        if self.archive is not None:
+            self.archive.parser_counts[parser_used] += 1
+        self._content_loaded()
+
+    def _content_loaded(self):
+        # Raw content is kept only if it could be read again, see unload
+        if self.shared_content is not None and not self.shared_content.reloadable:
+            self.shared_content = None
+        if not callable(self._file_content):
+            self._file_content = None
+        self._title_tag = self._page_content_parsed.find('.//title')
+        self._sections = []
         self.parse_sections()
 
-    def parse_page_content(self, page_content, cached_soup = {}):
-        page_key = hashlib.sha224(page_content.encode("utf-8")).hexdigest()
-        try:
-            if not cached_soup.has_key(page_key):
-                import lxml.html.soupparser
-                cached_soup[page_key] = lxml.html.soupparser.fromstring(page_content)
-            html = deepcopy(cached_soup[page_key])
-
-            body = html.find('.//body')
-            if body is None:
-                raise UnknownContentException()
-# for simplicity we decided to use BeatifulSoup parser for now
-#            html = etree.XML(page_content, etree.XMLParser())
-#            body = html.find('{%s}body' % NS['html'])
-#            if body is None:
-#                raise UnknownContentException()
-        except (ExpatError, etree.XMLSyntaxError, UnknownContentException):
-            raise
-#            logging.warning('Was not valid XHTML; trying with BeautifulSoup')
-#            try:
-#                import lxml.html.soupparser
-#                html = lxml.html.soupparser.fromstring(page_content)
-#                body = html.find('.//body')
-#                if body is None:
-#                    raise
-#            except:
-#                # Give up
-#                logging.error("Giving up on this content")
-#                raise UnknownContentException()
+    def unload(self):
+        '''Releases content, parsed content and sections of the page, they are read and
+        parsed again when accessed. Titles of the page are taken before the content is released
+        and kept, the page title is resolved from them again. Pages of not lazy archive
+        could not be read again, so they are left as they are'''
+        if not self.loaded or not self.reloadable:
+            return
+        self.title_text
+        self.sole_section_title
+        self._page_content = None
+        self._page_content_parsed = None
+        self._title_tag = None
+        self._sections = None
+        self._page_title = _NOT_SET
+
+    @property
+    def loaded(self):
+        return self._page_content_parsed is not None
+
+    @property
+    def reloadable(self):
+        return callable(self._file_content) or self.shared_content is not None
+
+    @property
+    def title_text(self):
+        '''Text of <title> of the page as unicode. Unless the page is loaded already,
+        just the head of its content is read and parsed'''
+        if self._title_text is _NOT_SET:
+            title_tag = None
+            if not self.loaded:
+                if self.shared_content is not None:
+                    title_tag = self.shared_content.head_title_tag()
+                else:
+                    title_tag = parse_head_title(self._file_content, *self.parse_options())
+            if title_tag is None:
+                title_tag = self.title_tag
+            self._title_text = as_unicode(title_tag.text)
+        return self._title_text
+
+    @property
+    def page_content(self):
+        self.load()
+        return self._page_content
+
+    @property
+    def page_content_parsed(self):
+        self.load()
+        return self._page_content_parsed
+
+    @property
+    def title_tag(self):
+        self.load()
+        return self._title_tag
+
+    @property
+    def sections(self):
+        self.load()
+        return self._sections
+
+    def parse_page_content(self, page_content):
+        stats = self.stats
+        if self.archive is None or self.current_anchor is None:
+            # The page is the whole file, which is not parsed for other pages
+            html, self.parser_used = self.parse_html(page_content)
+            if self.archive is not None:
+                self.archive.parser_counts[self.parser_used] += 1
+        else:
+            # Several navpoints might point to the same file (unless it is a SharedContentFile),
+            # so parsed files are cached
+            parse_cache = self.archive.parse_cache
+            page_key = (self.archive.parser_mode, hashlib.sha224(page_content.encode("utf-8")).hexdigest())
+            parsed = parse_cache.get(page_key)
+            if parsed is None:
+                parsed = self.parse_html(page_content)
+                parse_cache.put(page_key, parsed, len(page_content))
+            elif stats is not None:
+                stats.add("parse_cache_hit", page=self)
+            html, self.parser_used = parsed
+            html = deepcopy(html)
+            self.archive.parser_counts[self.parser_used] += 1
+
+        body = html.find('.//body')
+        if body is None:
+            raise UnknownContentException()
         if self.current_anchor is None:
             return html
-        elements_to_remove = []
-        start_elem, end_elem = find_bounding_elements(body, self.previous_anchor, None if self.current_anchor["id"] is None else self.current_anchor, self.next_anchor)
-
-        within_start_and_end_elem = True if start_elem is None else False
-        for elem in body.iterdescendants():
-            if elem == start_elem:
-                within_start_and_end_elem = True
-            elif elem == end_elem:
-                within_start_and_end_elem = False
-            if not within_start_and_end_elem and start_elem not in elem.iterdescendants():
-                elements_to_remove.append(elem)
-        for elem in elements_to_remove:
-            elem.clear()
-            try:
-                body.remove(elem)
-            except ValueError:
-                pass
+        start_elem, end_elem = self.find_bounding_elements(body)
+        if stats is not None:
+            start = time.time()
+        prune_page_range(body, start_elem, end_elem)
+        if stats is not None:
+            stats.add("prune_page_range", time.time() - start, page=self)
         return html
 
+    def find_bounding_elements(self, body, index=None):
+        """
+        Returns start and end elements of the page within body of its content file.
+        index is AnchorIndex of body, if it is built already
+        """
+        stats = self.stats
+        if stats is None:
+            return find_bounding_elements(body, *self.page_range_anchors(), index=index)
+        start = time.time()
+        bounding_elements = find_bounding_elements(body, *self.page_range_anchors(), stats=stats, page=self, index=index)
+        stats.add("find_bounding_elements", time.time() - start, page=self)
+        return bounding_elements
+
+    def page_range_anchors(self):
+        """
+        Returns anchors bounding the page within its content file: (previous, current, next),
+        or None if the page is the whole file
+        """
+        if self.current_anchor is None:
+            return None
+        return (self.previous_anchor, None if self.current_anchor["id"] is None else self.current_anchor, self.next_anchor)
+
     def get_page_title(self):
         """
         1. If there is a non-empty <title></title> header in the page and there is no other pages
@@ -553,28 +1536,65 @@ class EpubPage(object):
         Otherwise:
         4. Use the name from the spine
         """
-        if [page.title_tag.text for page in self.archive.pages].count(self.title_tag.text) == 1:
-            title =  self.title_tag.text
-        elif len(self.sections) == 1 and self.sections[0].title:
-            title = self.sections[0].title
+        if self._page_title is not _NOT_SET:
+            return self._page_title
+        if self.archive.count_page_titles(self.title_text) == 1:
+            title =  self.title_text
+        elif self.sole_section_title:
+            title = self.sole_section_title
         elif self.title_in_toc:
             title = self.title_in_toc
         else:
             title = self.idref
-        if isinstance(title, str):
+        if isinstance(title, basestring):
             title = title.strip()
+        self._page_title = title
         return title
 
 
+    @property
+    def sole_section_title(self):
+        '''Title of the only section of the page as unicode, None if there are several sections'''
+        if self._sole_section_title is _NOT_SET:
+            self._sole_section_title = as_unicode(self.sections[0].title) if len(self.sections) == 1 else None
+        return self._sole_section_title
+
+    def release_shared_content(self):
+        '''Detaches the page which is not going to be loaded (e.g. taken from the previous
+        conversion) from its shared content file, so that the file is released as soon
+        as the rest of its pages are carved out of it. If the page is loaded anyway,
+        it is read on its own'''
+        if self.shared_content is not None:
+            self.shared_content.remove_page(self)
+            self.shared_content = None
+
+    def set_titles(self, title_text, sole_section_title):
+        '''Sets title_text and sole_section_title known from the previous conversion
+        of the same content, so that get_page_title doesn't need to load the page'''
+        self._title_text = title_text
+        self._sole_section_title = sole_section_title
+        self._page_title = _NOT_SET
+
     def parse_sections(self):
         """
         Parses page content and builds hierarchy of sections judging on h1 - h6 tags
         """
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
         heading_tags = ("h1", "h2", "h3", "h4", "h5", "h6")
         current_section = EpubPageSection(self)
         current_section.bind_to_parent(None)
-        for elem in self.page_content_parsed.find(".//body").iterdescendants():
+        # Depth-first traversal of body in document order. Along with each element
+        # the stack holds sections whose content_elements include an ancestor of the element
+        # and whether the element is inside of a heading.
+        body = self.page_content_parsed.find(".//body")
+        stack = [(elem, (), False) for elem in body.iterchildren(reversed=True)]
+        while stack:
+            elem, owner_sections, in_heading = stack.pop()
             if elem.tag in heading_tags:
+                # Not collapsed by normalize_text: titles of sections are kept as they are
+                # (e.g. "Chapter  1" of pieces "Chapter " and " 1")
                 heading_text = " ".join([t.strip() for t in elem.itertext()])
                 heading_level = int(elem.tag[1])
                 if current_section.title is None and not current_section.has_text_before_title:
@@ -596,6 +1616,7 @@ class EpubPage(object):
                         )
                         new_section.bind_to_parent(parent)
                     current_section = new_section
+                stack.extend((child, owner_sections, True) for child in elem.iterchildren(reversed=True))
             else:
                 if (not current_section.has_text_before_title
                 and current_section.title is None
@@ -603,11 +1624,14 @@ class EpubPage(object):
                 and elem.text.strip()
                 ):
                     current_section.has_text_before_title = True
-                if ([e for e in elem.iterancestors() if
-                    (e in current_section.content_elements) or # skip children of elements already included to current section
-                    (e.tag in heading_tags)] == [] # skip children of heading tag, as they are part of the title
+                if (current_section not in owner_sections and # skip children of elements already included to current section
+                    not in_heading # skip children of heading tag, as they are part of the title
                 ):
                     current_section.content_elements.append(elem)
+                    owner_sections = owner_sections + (current_section, )
+                stack.extend((child, owner_sections, in_heading) for child in elem.iterchildren(reversed=True))
+        if stats is not None:
+            stats.add("parse_sections", time.time() - start, page=self, sections=len(self._sections))
 
     # XHTML content that has been sanitized.  This isn't done until
     # the user requests to access the file or until the automated
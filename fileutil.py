@@ -0,0 +1,56 @@
+'''Helpers for the files epub archives are read from'''
+import os, mmap
+from zipfile import ZipFile
+from cStringIO import StringIO
+
+
+def is_filename(source):
+    '''Tells whether source of EpubArchive is a file name rather than a file object or
+    content of the file. Every str and unicode is a file name; content held in memory
+    is given as bytearray, memoryview, buffer or mmap (content read as str is wrapped
+    in buffer() or memoryview(), which do not copy it)'''
+    return isinstance(source, basestring)
+
+def is_file_object(source):
+    '''Tells whether source of EpubArchive is an open file object (mmap has read() as well,
+    but it is content of the file)'''
+    return hasattr(source, 'read') and not isinstance(source, mmap.mmap)
+
+def map_file(filename):
+    '''Returns read-only memory map of the file'''
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def find_epub_files(paths):
+    '''Returns epub files from paths. Directories are searched for *.epub recursively'''
+    epub_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith('.epub'):
+                        epub_files.append(os.path.join(dirpath, filename))
+        else:
+            epub_files.append(path)
+    return epub_files
+
+
+class MappedZipFile(ZipFile):
+    '''ZipFile of memory mapped file, the file is unmapped on close()'''
+
+    def __init__(self, filename):
+        self.map = map_file(filename)
+        try:
+            # cStringIO reads the map through the buffer interface without copying it
+            ZipFile.__init__(self, StringIO(self.map), 'r')
+        except:
+            self.close()
+            raise
+        self.filename = filename
+
+    def close(self):
+        ZipFile.close(self)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,133 @@
+'''Fast reader of epub metadata. Just the container and the <metadata> of the OPF file are read:
+the OPF is parsed up to the end of <metadata>, content documents and the NCX are not touched.
+
+Usage: python metadata.py [options] EPUB_FILE_OR_DIR [EPUB_FILE_OR_DIR ...]'''
+import sys, time, json, logging, traceback
+import argparse
+from zipfile import ZipFile, BadZipfile
+from cStringIO import StringIO
+from multiprocessing import Pool
+
+from lxml import etree
+
+import constants
+from constants import NAMESPACES as NS
+from toc import InvalidEpubException, xml_from_string
+from epub import get_title, get_authors, get_metadata
+from fileutil import is_filename, is_file_object, find_epub_files
+
+METADATA_TAG = '{%s}metadata' % NS['opf']
+
+
+def get_opf_filename(container):
+    '''Returns name of the OPF file from parsed container'''
+    rootfile = container.find('.//{%s}rootfile' % NS['container'])
+    if rootfile is None:
+        raise InvalidEpubException("Could not find rootfile in %s" % constants.CONTAINER)
+    return rootfile.get('full-path')
+
+def parse_opf_metadata(opf_file):
+    '''Returns <metadata> element of OPF file object parsing the file just up to its end
+    (the element is in the partial tree of the document). The root of the whole document
+    is returned if there is no <metadata> element'''
+    context = etree.iterparse(opf_file, events=('end',), tag=METADATA_TAG)
+    try:
+        for (event, elem) in context:
+            return elem
+    except etree.XMLSyntaxError, e:
+        raise InvalidEpubException("Unable to parse OPF file: %s" % e)
+    return context.root
+
+def read_metadata(epub):
+    '''Returns metadata record of the book: dict with title, authors, subjects, language,
+    publisher, rights and description, which are the same as ones given by EpubArchive.
+    epub is the file name, an open file object or content of the file as bytearray,
+    memoryview, buffer or mmap (not str), see EpubArchive.
+    Raises InvalidEpubException if the book has no title, like EpubArchive does'''
+    z = ZipFile(epub if is_filename(epub) or is_file_object(epub) else StringIO(epub), 'r')
+    try:
+        try:
+            container = z.read(constants.CONTAINER)
+        except KeyError:
+            raise InvalidEpubException('Was not able to locate container file %s' % constants.CONTAINER)
+        opf_filename = get_opf_filename(xml_from_string(container))
+        try:
+            opf_file = z.open(opf_filename)
+        except KeyError:
+            raise InvalidEpubException('Could not find OPF file %s in archive' % opf_filename)
+        try:
+            metadata = parse_opf_metadata(opf_file)
+        finally:
+            opf_file.close()
+    finally:
+        z.close()
+    title = get_title(metadata)
+    if title is None:
+        raise InvalidEpubException('This ePub document does not have a title.')
+    return {
+        'title': title,
+        'authors': get_authors(metadata),
+        'subjects': list(get_metadata(metadata, constants.DC_SUBJECT_TAG, plural=True) or []),
+        'language': get_metadata(metadata, constants.DC_LANGUAGE_TAG, as_string=True) or '',
+        'publisher': list(get_metadata(metadata, constants.DC_PUBLISHER_TAG, plural=True) or []),
+        'rights': get_metadata(metadata, constants.DC_RIGHTS_TAG, as_string=True) or '',
+        'description': get_metadata(metadata, constants.DC_DESCRIPTION_TAG, as_string=True) or '',
+    }
+
+def read_book(epub_filename):
+    '''Returns metadata record of the book along with its file name ('epub') and error, if any;
+    errors are reported rather than raised'''
+    try:
+        record = read_metadata(epub_filename)
+        record['error'] = None
+    except (InvalidEpubException, BadZipfile, etree.XMLSyntaxError, IOError), e:
+        record = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    except Exception, e:
+        logging.error('Failed to read metadata of %s\n%s' % (epub_filename, traceback.format_exc()))
+        record = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    record['epub'] = epub_filename
+    return record
+
+def read_books(epub_filenames, processes=None, chunksize=64):
+    '''Yields records of read_book for epub_filenames in their order. Books are read by a pool
+    of processes (a process per CPU by default; with processes=1 in the current process),
+    which take chunksize books at a time'''
+    if processes == 1:
+        for epub_filename in epub_filenames:
+            yield read_book(epub_filename)
+        return
+    pool = Pool(processes)
+    try:
+        for record in pool.imap(read_book, epub_filenames, chunksize):
+            yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reads metadata of epub files as JSON lines')
+    parser.add_argument('paths', nargs='+', help='epub files or directories with them')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default=None, help='file to write records to (default: standard output)')
+    args = parser.parse_args(argv)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start = time.time()
+    books = failed = 0
+    try:
+        for record in read_books(find_epub_files(args.paths), args.processes):
+            output.write(json.dumps(record) + '\n')
+            books += 1
+            if record['error'] is not None:
+                failed += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    seconds = time.time() - start
+    sys.stderr.write('Read %d books (%d failed) in %.1fs (%.0f books/sec)\n'
+                     % (books, failed, seconds, books / seconds if seconds else 0))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
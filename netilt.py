@@ -1,4 +1,7 @@
+import os, time, shutil, json, tempfile
+from cStringIO import StringIO
 from epub import EpubArchive, EpubPageSection
+from constants import PARSER_AUTO, VERSION
 from lxml import etree
 
 def convert_xhtml_elements(xhtml_elements):
@@ -29,6 +32,66 @@ def epub_page_section_to_netilt(section, element_name, section_order):
     section_elem.extend(convert_xhtml_elements(xhtml_elements))
     return section_elem
 
+# Indentation of pretty printed XML
+INDENT = "  "
+
+def serialize_at_depth(elem, depth):
+    """
+    Returns pretty printed elem as it would be serialized within a pretty printed
+    document at the given depth: indented, with newline at the end
+    """
+    root = wrapper = etree.Element("wrapper")
+    for i in range(depth - 1):
+        wrapper = etree.SubElement(wrapper, "wrapper")
+    wrapper.append(elem)
+    xml = etree.tostring(root, encoding="UTF-8", pretty_print=True)
+    head = "".join(["%s<wrapper>\n" % (INDENT * i) for i in range(depth)])
+    tail = "".join(["%s</wrapper>\n" % (INDENT * i) for i in reversed(range(depth))])
+    return xml[len(head):len(xml) - len(tail)]
+
+def get_section_skeleton(section):
+    return {
+        "title": section.title,
+        "subsections": [get_section_skeleton(subsection) for subsection in section.children_sections],
+    }
+
+def get_page_key(page):
+    """
+    Returns string identifying the page in the manifest: the page is the same if its content
+    file is and its range in the file is bounded by the same navpoints
+    """
+    return json.dumps([page.filename, page.title_in_toc, page.previous_anchor, page.next_anchor], sort_keys=True)
+
+def get_page_depth(page):
+    """
+    Returns depth of the page element in the document: the page having children pages
+    and each of its ancestors open a chapter
+    """
+    depth = 2 if page.children_pages else 1
+    while page.parent_page is not None:
+        page = page.parent_page
+        depth += 1
+    return depth
+
+class Tee(object):
+    """File-like object writing to several files"""
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+
+class CountingWriter(object):
+    """File-like object writing to output and counting bytes written, see NetiltDoc.write_page"""
+    def __init__(self, output):
+        self.output = output
+        self.position = 0
+
+    def write(self, data):
+        self.output.write(data)
+        self.position += len(data)
+
 def get_netilt_doc_structure(netilt_doc):
     res = ""
     for elem in netilt_doc.iter():
@@ -43,35 +106,341 @@ def get_netilt_doc_structure(netilt_doc):
 
 
 class NetiltDoc(object):
-    def __init__(self, epub_filename):
+    def __init__(self, epub_filename, parser_mode=PARSER_AUTO, workers=1, cache=None, manifest_filename=None,
+                 stats=None, keep_pre_whitespace=False, use_mmap=False):
+        '''epub_filename is the file name of the book, an open file object or content of the file
+        (bytearray, memoryview, buffer or mmap; a str is the file name), see EpubArchive.
+        workers is the number of processes parsing pages of the book, see EpubArchive.
+        If cache (ConversionCache) is given, process() and write() return XML converted
+        earlier with the same options, if any; the archive is not opened then.
+        Skeleton of the converted book (titles of the pages and sections) is kept
+        in self.skeleton.
+        If manifest_filename is given, conversion is incremental: the manifest of the previous
+        conversion is read from the file, and pages whose content files have the same CRC-32
+        are not parsed but copied from the output file of that conversion (the manifest keeps
+        titles and offsets of the pages in it). The new manifest is written to the file
+        by write() to a file name, along with the output it describes; process() and write()
+        to a file object just reuse the pages.
+        Incremental conversion loads pages one at a time, so it could not have workers
+        (ValueError is raised).
+        If stats (stats.Stats) is given, stages of the conversion are recorded in it.
+        keep_pre_whitespace and use_mmap are passed to EpubArchive'''
+        if manifest_filename is not None and workers > 1:
+            raise ValueError("Pages of incremental conversion are not parsed by workers")
         self.epub_filename = epub_filename
+        self.parser_mode = parser_mode
+        self.workers = workers
+        self.cache = cache
+        self.manifest_filename = manifest_filename
+        self.stats = stats
+        self.keep_pre_whitespace = keep_pre_whitespace
+        self.use_mmap = use_mmap
         self.epub_archive = None
+        self.skeleton = None
+        self.manifest = None
         self.chapter_elements = {}
+        self._page_indexes = {}
+        self._reused_pages = {}
+        # Output of the previous conversion the reused pages are copied from
+        self._previous_output = None
 
-    def get_netilt_xml(self, use_spine_as_toc):
-        self.epub_archive = EpubArchive(self.epub_filename, use_spine_as_toc)
-        document = etree.Element("document")
-        add_element_with_text(document, "title", self.epub_archive.title)
-        add_element_with_text(document, "authors", ", ".join(self.epub_archive.authors))
+    def open_archive(self, use_spine_as_toc, lazy=False):
+        self.epub_archive = EpubArchive(
+            self.epub_filename, use_spine_as_toc, lazy=lazy, parser_mode=self.parser_mode,
+            workers=self.workers, stats=self.stats, keep_pre_whitespace=self.keep_pre_whitespace,
+            use_mmap=self.use_mmap
+        )
+        self.skeleton = {"title": self.epub_archive.title, "authors": self.epub_archive.authors, "pages": []}
+
+    def start_manifest(self, use_spine_as_toc):
+        self.manifest = {
+            "version": VERSION,
+            "options": [use_spine_as_toc, self.parser_mode, self.keep_pre_whitespace],
+            "pages": [],
+        }
+        self.reuse_pages(self.load_manifest())
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_filename) as f:
+                return json.load(f)
+        except IOError:
+            return None
 
+    def save_manifest(self, output_filename):
+        """
+        Writes the manifest describing output_filename written by the conversion
+        """
+        output_stat = os.stat(output_filename)
+        self.manifest["output"] = os.path.abspath(output_filename)
+        # The output is not reused if it is changed since
+        self.manifest["output_size"] = output_stat.st_size
+        self.manifest["output_mtime"] = output_stat.st_mtime
+        manifest_file = tempfile.NamedTemporaryFile(
+            "wb", suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.manifest_filename)), delete=False
+        )
+        with manifest_file:
+            # json.dump encodes in pure Python, dumps uses the C encoder
+            manifest_file.write(json.dumps(self.manifest))
+        os.rename(manifest_file.name, self.manifest_filename)
+
+    def reuse_pages(self, previous_manifest):
+        """
+        Finds pages which are converted the same way as in the previous manifest
+        and opens the previous output to copy them from
+        """
+        if previous_manifest is None or previous_manifest.get("output") is None:
+            return
+        if previous_manifest.get("version") != VERSION or previous_manifest.get("options") != self.manifest["options"]:
+            return
+        try:
+            output_stat = os.stat(previous_manifest["output"])
+        except OSError:
+            return
+        if (output_stat.st_size, output_stat.st_mtime) != (previous_manifest["output_size"], previous_manifest["output_mtime"]):
+            return
+        self._previous_output = open(previous_manifest["output"], "rb")
+        previous_pages = dict([(entry["key"], entry) for entry in previous_manifest["pages"]])
         for page in self.epub_archive.pages:
-            page_root_elem = self.chapter_elements.get(page.parent_page, document)
-            page_elem = etree.Element("page")
-            if page.children_pages:
-                add_element_with_text(page_elem, "title", "Overview")
-                chapter_elem = etree.Element("chapter")
-                if page.get_page_title() is not None:
-                    add_element_with_text(chapter_elem, "title", page.get_page_title())
-                page_root_elem.append(chapter_elem)
-                self.chapter_elements[page] = chapter_elem
-                page_root_elem = chapter_elem
-            else:
-                if page.get_page_title() is not None:
-                    add_element_with_text(page_elem, "title", page.get_page_title())
-            page_root_elem.append(page_elem)
-            for index, section in enumerate(page.sections):
-                page_elem.append(epub_page_section_to_netilt(section, "section", index))
+            entry = previous_pages.get(get_page_key(page))
+            if (entry is not None and entry["crc"] == self.epub_archive.get_page_crc(page)
+                    and entry["depth"] == get_page_depth(page)):
+                page.set_titles(entry["title_text"], entry["sole_section_title"])
+                page.release_shared_content()
+                self._reused_pages[page] = entry
+
+    def close_previous_output(self):
+        if self._previous_output is not None:
+            self._previous_output.close()
+            self._previous_output = None
+
+    def get_netilt_xml(self, use_spine_as_toc):
+        if self.stats is not None:
+            start = time.time()
+        self.open_archive(use_spine_as_toc)
+        # The archive file is closed as soon as the pages are converted
+        with self.epub_archive:
+            document = etree.Element("document")
+            add_element_with_text(document, "title", self.epub_archive.title)
+            add_element_with_text(document, "authors", ", ".join(self.epub_archive.authors))
+
+            for page in self.epub_archive.pages:
+                page_root_elem = self.chapter_elements.get(page.parent_page, document)
+                (chapter_elem, page_elem) = self.get_page_elements(page)
+                if chapter_elem is not None:
+                    page_root_elem.append(chapter_elem)
+                    self.chapter_elements[page] = chapter_elem
+                    page_root_elem = chapter_elem
+                page_root_elem.append(page_elem)
+        if self.stats is not None:
+            self.stats.add("get_netilt_xml", time.time() - start, pages=len(self._page_indexes))
         return document
 
+    def get_page_elements(self, page):
+        """
+        Returns tuple (chapter element or None, page element) for the page.
+        The page with children pages opens a chapter, and its own content
+        goes to the first page of the chapter
+        """
+        if self.stats is not None:
+            start = time.time()
+        chapter_elem = None
+        page_elem = etree.Element("page")
+        if page.children_pages:
+            add_element_with_text(page_elem, "title", "Overview")
+            chapter_elem = etree.Element("chapter")
+            if page.get_page_title() is not None:
+                add_element_with_text(chapter_elem, "title", page.get_page_title())
+        else:
+            if page.get_page_title() is not None:
+                add_element_with_text(page_elem, "title", page.get_page_title())
+        # Sections of reused page are copied from the previous output by write_page
+        entry = self._reused_pages.get(page)
+        reused = entry is not None
+        if reused:
+            section_elems = []
+            sections_skeleton = entry["skeleton"]
+        else:
+            section_elems = [
+                epub_page_section_to_netilt(section, "section", index) for index, section in enumerate(page.sections)
+            ]
+            sections_skeleton = [get_section_skeleton(section) for section in page.sections]
+        self.add_page_skeleton(page, sections_skeleton)
+        page_elem.extend(section_elems)
+        if self.stats is not None:
+            self.stats.add("convert_page", time.time() - start, page=page, reused=int(reused))
+        return (chapter_elem, page_elem)
+
+    def write_page(self, output, page, page_elem, depth):
+        """
+        Writes page element to output (CountingWriter) as it is serialized in the document
+        at the given depth. Sections of the reused page are copied from the previous output.
+        Position and length of the sections in the output are recorded in the manifest
+        """
+        entry = self._reused_pages.pop(page, None)
+        elems = list(page_elem)
+        if entry is None:
+            sections = "".join([serialize_at_depth(elem, depth + 1) for elem in elems if elem.tag == "section"])
+        else:
+            self._previous_output.seek(entry["offset"])
+            sections = self._previous_output.read(entry["length"])
+        title_elems = [elem for elem in elems if elem.tag == "title"]
+        if not title_elems and not sections:
+            output.write("%s<page/>\n" % (INDENT * depth))
+            offset = output.position
+        else:
+            output.write("%s<page>\n" % (INDENT * depth))
+            for elem in title_elems:
+                output.write(serialize_at_depth(elem, depth + 1))
+            offset = output.position
+            output.write(sections)
+            output.write("%s</page>\n" % (INDENT * depth))
+        if self.manifest is not None:
+            self.manifest["pages"].append({
+                "key": get_page_key(page),
+                "crc": self.epub_archive.get_page_crc(page),
+                "title_text": page.title_text,
+                "sole_section_title": page.sole_section_title,
+                "skeleton": self.skeleton["pages"][self._page_indexes[page]]["sections"],
+                "depth": depth,
+                "offset": offset,
+                "length": len(sections),
+            })
+
+    def add_page_skeleton(self, page, sections_skeleton):
+        self._page_indexes[page] = len(self.skeleton["pages"])
+        self.skeleton["pages"].append({
+            "title": page.get_page_title(),
+            "parent": self._page_indexes.get(page.parent_page),
+            "sections": sections_skeleton,
+        })
+
+    def get_cache_key(self, use_spine_as_toc):
+        return self.cache.get_key(self.epub_filename, (use_spine_as_toc, self.parser_mode, self.keep_pre_whitespace))
+
+    def get_cached(self, cache_key):
+        """
+        Returns name of the cached XML file and loads cached skeleton, or returns None
+        """
+        xml_filename = self.cache.get(cache_key)
+        if xml_filename is not None:
+            self.skeleton = self.cache.get_skeleton(cache_key)
+            if self.skeleton is None:
+                # Evicted in the meantime
+                xml_filename = None
+        if self.stats is not None:
+            self.stats.add("cache_hit" if xml_filename is not None else "cache_miss")
+        return xml_filename
+
     def process(self, use_spine_as_toc):
-        return etree.tostring(self.get_netilt_xml(use_spine_as_toc), xml_declaration=True, encoding="UTF-8", pretty_print=True)
+        if self.cache is not None:
+            cache_key = self.get_cache_key(use_spine_as_toc)
+            xml_filename = self.get_cached(cache_key)
+            if xml_filename is not None:
+                with open(xml_filename, "rb") as f:
+                    return f.read()
+        if self.manifest_filename is not None:
+            # Pages of incremental conversion are copied from the previous output
+            # rather than built, so the XML is written
+            output = StringIO()
+            self.write_pages(output, use_spine_as_toc)
+            xml = output.getvalue()
+        else:
+            document = self.get_netilt_xml(use_spine_as_toc)
+            if self.stats is not None:
+                start = time.time()
+            xml = etree.tostring(document, xml_declaration=True, encoding="UTF-8", pretty_print=True)
+            if self.stats is not None:
+                self.stats.add("serialization", time.time() - start, bytes=len(xml))
+        if self.cache is not None:
+            self.cache.put(cache_key, xml, self.skeleton)
+        return xml
+
+    def write(self, output, use_spine_as_toc):
+        """
+        Writes Netilt XML to output (file name or file object) page by page, without
+        building the whole document. Written XML is the same as returned by process().
+        Unless pages are parsed by workers, they are loaded one at a time.
+        Output file is written as a temporary file, which replaces it once the whole
+        document is written, so a failed conversion leaves no partial output (and pages
+        of incremental conversion are copied from the previous output while it is written)
+        """
+        if isinstance(output, basestring):
+            output_file = tempfile.NamedTemporaryFile(
+                "wb", suffix=".tmp", dir=os.path.dirname(os.path.abspath(output)), delete=False
+            )
+            try:
+                with output_file:
+                    self.write(output_file, use_spine_as_toc)
+            except:
+                os.remove(output_file.name)
+                raise
+            os.rename(output_file.name, output)
+            # Unless the XML is taken from the cache
+            if self.manifest is not None:
+                self.save_manifest(output)
+            return
+        if self.cache is None:
+            return self.write_pages(output, use_spine_as_toc)
+        cache_key = self.get_cache_key(use_spine_as_toc)
+        xml_filename = self.get_cached(cache_key)
+        if xml_filename is not None:
+            with open(xml_filename, "rb") as f:
+                shutil.copyfileobj(f, output)
+            return
+        cache_file = self.cache.new_file()
+        try:
+            self.write_pages(Tee(output, cache_file), use_spine_as_toc)
+        except:
+            cache_file.close()
+            os.remove(cache_file.name)
+            raise
+        cache_file.close()
+        self.cache.put(cache_key, cache_file, self.skeleton)
+
+    def write_pages(self, output, use_spine_as_toc):
+        if self.stats is not None:
+            start = time.time()
+        self.open_archive(use_spine_as_toc, lazy=not self.workers > 1)
+        output = CountingWriter(output)
+        # The archive file is closed as soon as the pages are converted
+        with self.epub_archive:
+            if self.manifest_filename is not None:
+                self.start_manifest(use_spine_as_toc)
+            try:
+                self.write_document(output)
+            finally:
+                self.close_previous_output()
+        if self.stats is not None:
+            self.stats.add("write_pages", time.time() - start, pages=len(self._page_indexes))
+
+    def write_document(self, output):
+        """
+        Writes the document of the open archive to output (CountingWriter)
+        """
+        output.write("<?xml version='1.0' encoding='UTF-8'?>\n<document>\n")
+        title_elem = etree.Element("title")
+        title_elem.text = self.epub_archive.title
+        output.write(serialize_at_depth(title_elem, 1))
+        authors_elem = etree.Element("authors")
+        authors_elem.text = ", ".join(self.epub_archive.authors)
+        output.write(serialize_at_depth(authors_elem, 1))
+
+        # Pages come in document order, so chapters are closed as soon as
+        # a page which is not a descendant of their page is met
+        chapter_pages = []
+        for page in self.epub_archive.iter_pages():
+            while chapter_pages and chapter_pages[-1] is not page.parent_page:
+                chapter_pages.pop()
+                output.write("%s</chapter>\n" % (INDENT * (len(chapter_pages) + 1)))
+            (chapter_elem, page_elem) = self.get_page_elements(page)
+            if chapter_elem is not None:
+                output.write("%s<chapter>\n" % (INDENT * (len(chapter_pages) + 1)))
+                chapter_pages.append(page)
+                for elem in chapter_elem:
+                    output.write(serialize_at_depth(elem, len(chapter_pages) + 1))
+            self.write_page(output, page, page_elem, len(chapter_pages) + 1)
+        while chapter_pages:
+            chapter_pages.pop()
+            output.write("%s</chapter>\n" % (INDENT * (len(chapter_pages) + 1)))
+        output.write("</document>\n")
@@ -0,0 +1,61 @@
+'''Instrumentation of the conversion: wall time, calls and counters per stage and per page'''
+import json
+
+
+class Stats(object):
+    '''Collects statistics of the conversion. It is passed as stats to EpubArchive, TOC and NetiltDoc,
+    which record their stages with add(); without it nothing is measured at all.
+
+    For every stage there are the number of calls, total time in seconds and any counters
+    (e.g. number of elements) given by the stage. Stages which are done for a page are
+    recorded for the page as well. Stages might be nested (e.g. "load_pages" includes
+    "parse" of every page), so their times are not to be summed up.'''
+
+    def __init__(self):
+        self.stages = {}
+        self.pages = []
+        self._page_records = {}
+
+    def add(self, stage, seconds=0.0, page=None, **counters):
+        '''Records a call of the stage which took seconds and adds counters to the ones of the stage'''
+        record = self.stages.get(stage)
+        if record is None:
+            record = self.stages[stage] = {"calls": 0, "seconds": 0.0}
+        record["calls"] += 1
+        record["seconds"] += seconds
+        for (name, value) in counters.items():
+            record[name] = record.get(name, 0) + value
+        if page is not None:
+            page_record = self.page_record(page)
+            page_record["seconds"][stage] = page_record["seconds"].get(stage, 0.0) + seconds
+            for (name, value) in counters.items():
+                page_record[name] = page_record.get(name, 0) + value
+
+    def page_record(self, page):
+        record = self._page_records.get(page)
+        if record is None:
+            record = self._page_records[page] = {"filename": page.filename, "seconds": {}}
+            self.pages.append(record)
+        return record
+
+    def summary(self):
+        return {
+            "stages": self.stages,
+            "pages": self.pages,
+        }
+
+    def dump(self, output):
+        '''Writes summary as JSON to output (file name or file object)'''
+        if isinstance(output, basestring):
+            with open(output, "w") as f:
+                return self.dump(f)
+        output.write(json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def report(self):
+        '''Returns stages as text table, the slowest first'''
+        lines = []
+        for (stage, record) in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+            counters = ", ".join(["%s=%s" % (name, value) for (name, value) in sorted(record.items())
+                                  if name not in ("calls", "seconds")])
+            lines.append("%-24s %8d calls %10.4fs  %s" % (stage, record["calls"], record["seconds"], counters))
+        return "\n".join(lines)
@@ -0,0 +1,186 @@
+'''Synthetic content for benchmarks and scale testing: pages, NCX documents and whole epub files'''
+import argparse
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+from constants import NAMESPACES as NS, CONTAINER, MIMETYPE, XHTML_MIMETYPE
+
+# Approximate number of elements in a block of synthetic_blocks
+ELEMENTS_PER_BLOCK = 28
+
+
+def synthetic_blocks(elements_count, blocks_per_heading=50, first_block=0):
+    '''Returns XHTML markup having about elements_count elements: paragraphs, tables and
+    code listings with a heading of one of several levels before every blocks_per_heading of them'''
+    blocks = []
+    count = 0
+    rows = "".join(["<tr><td>%d</td><td><em>cell</em></td></tr>" % row for row in range(5)])
+    index = first_block
+    while count < elements_count:
+        if index % blocks_per_heading == 0:
+            level = index / blocks_per_heading % 3 + 1
+            blocks.append('<h%d>Heading %d</h%d>' % (level, index, level))
+        blocks.append(
+            '<p>Paragraph <a href="#p%(index)d">with link</a> and <em>emphasis</em></p>'
+            '<div><table>%(rows)s</table></div>'
+            '<pre><code>(define (f x)<br/>(* x x))</code></pre>' % {"index": index, "rows": rows}
+        )
+        index += 1
+        count += ELEMENTS_PER_BLOCK
+    return "".join(blocks)
+
+def synthetic_page(elements_count, blocks_per_heading=50):
+    '''Returns XHTML page of synthetic_blocks'''
+    return '<html><head><title>Synthetic</title></head><body>%s</body></html>' % synthetic_blocks(
+        elements_count, blocks_per_heading
+    )
+
+def synthetic_ncx(navpoints_count, children_count=10):
+    '''Returns NCX document with navpoints_count navpoints, each navpoint has up to
+    children_count children'''
+    def nav_point(index):
+        return ('<navPoint id="np%(index)d" playOrder="%(order)d"><navLabel><text>Point %(index)d</text></navLabel>'
+                '<content src="page%(file)d.html#p%(index)d"/>' % {"index": index, "order": index + 1, "file": index / 10})
+    parts = []
+    # navpoints are numbered in breadth-first order starting from 1, so that children of
+    # navpoint i are i*n+1 .. i*n+n (and navpoints 1 .. n are top level ones)
+    def add_children(index):
+        for child in range(index * children_count + 1, index * children_count + children_count + 1):
+            if child <= navpoints_count:
+                parts.append(nav_point(child))
+                add_children(child)
+                parts.append('</navPoint>')
+    add_children(0)
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            '<docTitle><text>Synthetic</text></docTitle><navMap>%s</navMap></ncx>' % "".join(parts))
+
+
+def content_file(file_index, anchors_count, elements_count, blocks_per_heading=50, malformed=False, title=None):
+    '''Returns XHTML content file split into anchors_count parts of about equal size,
+    each part starts with a heading having id "fFILE_INDEX-ANCHOR_INDEX".
+    Malformed file is not well-formed XML (it has unclosed <br> tags), so BeautifulSoup parses it'''
+    parts = []
+    for anchor_index in range(anchors_count):
+        parts.append('<h1 id="f%d-%d">Part %d.%d</h1>' % (file_index, anchor_index, file_index, anchor_index))
+        parts.append(synthetic_blocks(elements_count / anchors_count, blocks_per_heading, anchor_index * 1000))
+    body = "".join(parts)
+    if malformed:
+        body = body.replace("<br/>", "<br>")
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<html xmlns="%s"><head><title>%s</title></head><body>%s</body></html>'
+            % (NS['html'], title or "File %d" % file_index, body))
+
+def content_filename(file_index):
+    return 'file%d.html' % file_index
+
+def nest(items, depth, children_count):
+    '''Returns items arranged into trees in preorder: list of (item, children) tuples where
+    items up to the depth level have up to children_count children'''
+    items = list(items)
+    items.reverse()
+    def tree(level):
+        item = items.pop()
+        children = []
+        while level < depth and items and len(children) < children_count:
+            children.append(tree(level + 1))
+        return (item, children)
+    trees = []
+    while items:
+        trees.append(tree(1))
+    return trees
+
+def trees_depth(trees):
+    '''Returns the number of levels of trees as returned by nest'''
+    return max([1 + trees_depth(children) for (item, children) in trees] or [0])
+
+def navpoints_markup(trees, order=None):
+    '''Returns markup of navpoints, trees are as returned by nest, items are (id, label, src)'''
+    if order is None:
+        order = [0]
+    parts = []
+    for ((navpoint_id, label, src), children) in trees:
+        order[0] += 1
+        parts.append('<navPoint id="%s" playOrder="%d"><navLabel><text>%s</text></navLabel><content src="%s"/>'
+                     % (navpoint_id, order[0], label, src))
+        parts.append(navpoints_markup(children, order))
+        parts.append('</navPoint>')
+    return "".join(parts)
+
+def make_epub(filename, files_count=10, navpoints_per_file=1, elements_per_page=2000, depth=1, children_count=5,
+              blocks_per_heading=50, malformed_every=0, unique_titles=True, title='Synthetic'):
+    '''Writes EPUB 2 file with files_count spine items (content files), each of about elements_per_page
+    elements with a heading before every blocks_per_heading blocks of them (see synthetic_blocks).
+    Every file has navpoints_per_file navpoints pointing to anchors in it, like sicp.epub.
+    Navpoints are nested up to depth levels, each one has up to children_count children.
+    Every malformed_every-th file is not well-formed (0 means none).
+    Unless unique_titles is set, all files have the same <title>, so that page titles
+    are taken from headings'''
+    container = ('<?xml version="1.0"?>'
+                 '<container version="1.0" xmlns="%s"><rootfiles>'
+                 '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                 '</rootfiles></container>' % NS['container'])
+    items = ['<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>']
+    itemrefs = []
+    navpoints = []
+    for file_index in range(files_count):
+        items.append('<item id="file%d" href="%s" media-type="%s"/>'
+                     % (file_index, content_filename(file_index), XHTML_MIMETYPE))
+        itemrefs.append('<itemref idref="file%d"/>' % file_index)
+        for anchor_index in range(navpoints_per_file):
+            src = content_filename(file_index)
+            if anchor_index > 0:
+                src = '%s#f%d-%d' % (src, file_index, anchor_index)
+            navpoints.append(("np%d-%d" % (file_index, anchor_index), "Part %d.%d" % (file_index, anchor_index), src))
+    opf = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<package xmlns="%s" version="2.0" unique-identifier="bookid">'
+           '<metadata xmlns:dc="%s"><dc:title>%s</dc:title><dc:creator>Generator</dc:creator>'
+           '<dc:language>en</dc:language><dc:identifier id="bookid">synthetic</dc:identifier></metadata>'
+           '<manifest>%s</manifest><spine toc="ncx">%s</spine></package>'
+           % (NS['opf'], NS['dc'], title, "".join(items), "".join(itemrefs)))
+    trees = nest(navpoints, depth, children_count)
+    # There is no pageList, so page count and maximal page number are 0
+    ncx = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<ncx xmlns="%s" version="2005-1"><head><meta name="dtb:uid" content="synthetic"/>'
+           '<meta name="dtb:depth" content="%d"/><meta name="dtb:totalPageCount" content="0"/>'
+           '<meta name="dtb:maxPageNumber" content="0"/></head>'
+           '<docTitle><text>%s</text></docTitle><navMap>%s</navMap></ncx>'
+           % (NS['ncx'], trees_depth(trees), title, navpoints_markup(trees)))
+    epub = ZipFile(filename, 'w', ZIP_DEFLATED)
+    try:
+        # mimetype has to be the first entry, not compressed
+        epub.writestr('mimetype', MIMETYPE, ZIP_STORED)
+        epub.writestr(CONTAINER, container)
+        epub.writestr('OEBPS/content.opf', opf)
+        epub.writestr('OEBPS/toc.ncx', ncx)
+        for file_index in range(files_count):
+            malformed = malformed_every > 0 and file_index % malformed_every == malformed_every - 1
+            epub.writestr('OEBPS/%s' % content_filename(file_index), content_file(
+                file_index, navpoints_per_file, elements_per_page, blocks_per_heading, malformed,
+                None if unique_titles else title
+            ))
+    finally:
+        epub.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates synthetic epub file")
+    parser.add_argument("filename")
+    parser.add_argument("--files", type=int, default=10, help="content files (spine items) (default: %(default)s)")
+    parser.add_argument("--navpoints-per-file", type=int, default=1, help="navpoints in each file (default: %(default)s)")
+    parser.add_argument("--elements-per-page", type=int, default=2000,
+                        help="elements in each file (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=1, help="nesting depth of navpoints (default: %(default)s)")
+    parser.add_argument("--children", type=int, default=5,
+                        help="children of each navpoint above the depth (default: %(default)s)")
+    parser.add_argument("--blocks-per-heading", type=int, default=50,
+                        help="blocks of about %d elements between headings (default: %%(default)s)" % ELEMENTS_PER_BLOCK)
+    parser.add_argument("--malformed-every", type=int, default=0,
+                        help="every N-th file is not well-formed (default: none)")
+    parser.add_argument("--same-titles", action="store_true", help="all files have the same <title>")
+    args = parser.parse_args(argv)
+    make_epub(args.filename, args.files, args.navpoints_per_file, args.elements_per_page, args.depth, args.children,
+              args.blocks_per_heading, args.malformed_every, not args.same_titles)
+
+
+if __name__ == "__main__":
+    main()
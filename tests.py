@@ -1,6 +1,22 @@
+import os, json, mmap, time, logging
 from unittest import TestCase
-from epub import EpubPage, EpubArchive
+from tempfile import mkdtemp
+from shutil import rmtree, copyfile
+from copy import deepcopy
+from StringIO import StringIO
+from zipfile import ZipFile
+from lxml import etree
+from epub import EpubPage, EpubArchive, normalize_text, parse_html, prune_page_range, copy_page_range, index_positions
+from epub import AnchorIndex, find_bounding_elements, normalize_content, parse_head, dump_tree
+from toc import TOC
+from constants import PARSER_AUTO
 from netilt import NetiltDoc
+from cache import ParseCache, ConversionCache, ZipFilePool
+from batch import convert_books, get_output_filenames, main as batch_main
+from fileutil import find_epub_files
+from synthetic import make_epub
+from stats import Stats
+from metadata import read_metadata, read_books
 
 class PageContentElementTest(TestCase):
     def test_(self):
@@ -8,6 +24,19 @@ class PageContentElementTest(TestCase):
         page = EpubPage(None, None, None, in_html, None, None)
         self.assertEqual(len(page.sections[0].content_elements), 3)
 
+class NormalizeTextTest(TestCase):
+    def test_normalize_text(self):
+        self.assertEqual(normalize_text(" <p>a\xc2\xa0 b\n\tc</p> "), u"<p>a b c</p>")
+        self.assertEqual(normalize_text(u"a\u00A0\u00A0b\u3000", keep_whitespace=True), u"a  b\u3000")
+
+    def test_keep_pre_whitespace(self):
+        content = "<html><head><title> A  title </title></head><body><pre>a\n  b</pre></body></html>"
+        self.assertEqual(normalize_content(content), normalize_text(content))
+        self.assertEqual(normalize_content(content, keep_pre_whitespace=True), content)
+        self.assertEqual(normalize_content("<p>a\n  b</p>", keep_pre_whitespace=True), u"<p>a b</p>")
+        self.assertEqual(parse_head(content, keep_pre_whitespace=True).text, " A  title ")
+        self.assertEqual(parse_head(content).text, " A title ")
+
 class PageSectionTest(TestCase):
     def test_top_level_heading(self):
         in_html = open("test_data/page_sections/in1.html").read()
@@ -63,6 +92,12 @@ class PageSectionTest(TestCase):
         self.assertEqual(page.sections[2].title, "The Three States")
         self.assertEqual(page.sections[2].children_sections, [])
 
+    def test_heading_nested_in_content_element(self):
+        page = EpubPage(None, None, None, "<html><body><div><p>x</p><h2>Title</h2><p>y</p></div></body></html>", None, None)
+        self.assertEqual([s.title for s in page.sections], [None, "Title"])
+        self.assertEqual([e.tag for e in page.sections[0].content_elements], ["div"])
+        self.assertEqual([e.text for e in page.sections[1].content_elements], ["y"])
+
 class PagesFromNavPointsTest(TestCase):
     def test_nav_alice_short(self):
         simple_archive = EpubArchive("test_data/in1.epub", False)
@@ -190,6 +225,772 @@ class PagesFromSpineTest(TestCase):
         archive = EpubArchive("test_data/in1.epub")
         self.assertEqual(len(archive.pages), 5)
 
+class ParserModeTest(TestCase):
+    def test_xhtml_and_soup_fallback(self):
+        page = EpubPage(None, None, None, '<html><head><title>T</title></head><body><p>text</p></body></html>', None, None)
+        self.assertEqual(page.parser_used, "xhtml")
+        page = EpubPage(None, None, None, '<html><head><title>T</title></head><body><p>text<br></body></html>', None, None)
+        self.assertEqual(page.parser_used, "soup")
+        self.assertEqual(page.title_tag.text, "T")
+
+    def test_same_sections_as_soup(self):
+        archive = EpubArchive("test_data/sicp.epub", parser_mode="auto")
+        soup_archive = EpubArchive("test_data/sicp.epub", parser_mode="soup")
+        self.assertEqual(archive.parser_counts, {"xhtml": 37, "soup": 0})
+        self.assertEqual(soup_archive.parser_counts, {"xhtml": 0, "soup": 37})
+
+    def test_same_titles_and_sections_for_all_books(self):
+        def section_tree(sections):
+            return [(s.title, s.title_level, section_tree(s.children_sections)) for s in sections]
+        def pages(archive):
+            return [(p.get_page_title(), section_tree(p.sections)) for p in archive.pages]
+        books = sorted(f for f in os.listdir("test_data") if f.endswith(".epub"))
+        self.assertTrue("in1.epub" in books and "sicp.epub" in books)
+        for book in books:
+            for use_spine_as_toc in (True, False):
+                filename = os.path.join("test_data", book)
+                self.assertEqual(
+                    pages(EpubArchive(filename, use_spine_as_toc, parser_mode="auto")),
+                    pages(EpubArchive(filename, use_spine_as_toc, parser_mode="soup")),
+                    "%s, use_spine_as_toc=%s" % (book, use_spine_as_toc)
+                )
+        # in1.epub has no markup BeautifulSoup would rewrite, so the whole output is the same
+        self.assertEqual(NetiltDoc("test_data/in1.epub").process(True),
+                         NetiltDoc("test_data/in1.epub", parser_mode="soup").process(True))
+
+class ParseCacheTest(TestCase):
+    def test_lru_eviction(self):
+        cache = ParseCache(max_entries=2, max_bytes=10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3, 4) # too many bytes, "b" is least recently used
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+        cache.put("d", 4, 1) # too many entries
+        self.assertEqual(cache.get("a"), None)
+        cache.put("e", 5, 11) # does not fit at all
+        self.assertEqual(cache.get("e"), None)
+        self.assertEqual(
+            cache.stats(),
+            {"entries": 2, "bytes": 5, "hits": 2, "misses": 3, "evictions": 2}
+        )
+
+    def test_navpoints_share_parsed_file(self):
+        cache = ParseCache()
+        archive = EpubArchive("test_data/sicp.epub", False, parse_cache=cache, split_shared_files=False)
+        # Each of 23 files with several navpoints is parsed once,
+        # 5 files with a single navpoint are not cached
+        self.assertEqual(cache.misses, 23)
+        self.assertEqual(cache.hits, len(archive.pages) - 28)
+        EpubArchive("test_data/sicp.epub", False, parse_cache=cache, split_shared_files=False)
+        self.assertEqual(cache.misses, 23)
+
+    def test_whole_files_are_not_cached(self):
+        archive = EpubArchive("test_data/sicp.epub", True)
+        self.assertTrue(all(page.loaded for page in archive.pages))
+        self.assertEqual(len(archive.parse_cache), 0)
+        self.assertEqual(archive.parse_cache.misses, 0)
+
+class SharedContentFileTest(TestCase):
+    def test_same_pages_as_without_split(self):
+        archive = EpubArchive("test_data/sicp.epub", False)
+        unsplit_archive = EpubArchive("test_data/sicp.epub", False, split_shared_files=False)
+        # Shared files are parsed once by SharedContentFile, files with single navpoint
+        # are parsed for their pages
+        self.assertEqual(archive.parse_cache.misses, 0)
+        self.assertEqual(
+            [etree.tostring(p.page_content_parsed) for p in archive.pages],
+            [etree.tostring(p.page_content_parsed) for p in unsplit_archive.pages]
+        )
+        self.assertEqual(
+            [[s.title for s in p.sections] for p in archive.pages],
+            [[s.title for s in p.sections] for p in unsplit_archive.pages]
+        )
+
+def reference_prune_page_range(body, start_elem, end_elem):
+    """Straightforward quadratic version of prune_page_range"""
+    elements_to_remove = []
+    within_start_and_end_elem = True if start_elem is None else False
+    for elem in body.iterdescendants():
+        if elem == start_elem:
+            within_start_and_end_elem = True
+        elif elem == end_elem:
+            within_start_and_end_elem = False
+        if not within_start_and_end_elem and start_elem not in elem.iterdescendants():
+            elements_to_remove.append(elem)
+    for elem in elements_to_remove:
+        elem.clear()
+        try:
+            body.remove(elem)
+        except ValueError:
+            pass
+
+class PageRangeTest(TestCase):
+    def _check_archive(self, filename):
+        archive = EpubArchive(filename, False, lazy=True)
+        zip_file = ZipFile(filename)
+        pages = [page for page in archive.pages if page.current_anchor is not None]
+        self.assertTrue(pages)
+        for page in pages:
+            html, parser_used = parse_html(normalize_text(zip_file.read("OEBPS/" + page.filename.split("#")[0])))
+            results = []
+            for prune in (reference_prune_page_range, prune_page_range):
+                page_html = deepcopy(html)
+                body = page_html.find(".//body")
+                start_elem, end_elem = page.find_bounding_elements(body)
+                prune(body, start_elem, end_elem)
+                results.append(etree.tostring(page_html))
+            body = html.find(".//body")
+            start_elem, end_elem = page.find_bounding_elements(body)
+            results.append(etree.tostring(copy_page_range(html, body, start_elem, end_elem, index_positions(html))))
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0], results[2])
+
+    def test_sicp(self):
+        self._check_archive("test_data/sicp.epub")
+
+    def test_anchor_index(self):
+        html, parser_used = parse_html(
+            '<html><body><div><h1 id="a">One</h1></div><p id="b">x</p><p id="b">y</p>'
+            '<h2>Two</h2><p><a href="#c">Link</a></p><h2>Three</h2><h2>Two</h2><h2>Four</h2></body></html>'
+        )
+        body = html.find(".//body")
+        index = AnchorIndex(body)
+        self.assertEqual(index.find_anchor("a", None).tag, "div")
+        self.assertEqual(index.find_anchor("b", "No such link"), None)
+        self.assertEqual(index.find_anchor("b", "Link").tag, "p")
+        self.assertEqual(index.find_headings(["Two", "Four"]), 3)
+        self.assertEqual(index.find_headings(["Two", "Five"]), None)
+        start_elem, end_elem = find_bounding_elements(
+            body, {"id": None, "title": "Three"}, {"id": "x", "title": "Two"}, {"id": "y", "title": "Four"}, index=index
+        )
+        self.assertEqual((start_elem.text, end_elem.text), ("Two", "Four"))
+
+class PageTitleTest(TestCase):
+    def test_title_counts(self):
+        archive = EpubArchive("test_data/sicp.epub", False)
+        titles = [page.title_tag.text for page in archive.pages]
+        for title in set(titles):
+            self.assertEqual(archive.count_page_titles(title), titles.count(title))
+        self.assertEqual(archive.count_page_titles("No such title"), 0)
+
+    def test_lazy_archive_titles(self):
+        archive = EpubArchive("test_data/sicp.epub", False)
+        lazy_archive = EpubArchive("test_data/sicp.epub", False, lazy=True)
+        self.assertEqual(lazy_archive.pages[5].get_page_title(), "1.1.2 Naming and the Environment")
+        self.assertEqual(
+            [page.get_page_title() for page in lazy_archive.pages],
+            [page.get_page_title() for page in archive.pages]
+        )
+
+    def test_head_title_of_malformed_file(self):
+        # XHTML and BeautifulSoup give different text of the title, it has to be the one of the whole file
+        content = '<html><head><title>A <!-- c --> B</title></head><body><p>text<br></body></html>'
+        page = EpubPage(None, None, None, content, None, None)
+        self.assertEqual(page.parser_used, "soup")
+        self.assertEqual(parse_head(content).text, page.title_tag.text)
+        # Just the head is read, the whole file is read as the title has a comment
+        head = content[:content.index("<body>")]
+        self.assertEqual(parse_head(head, read_file=lambda: content).text, page.title_tag.text)
+        content = content.replace("<br>", "<br/></p>")
+        page = EpubPage(None, None, None, content, None, None)
+        self.assertEqual(page.parser_used, "xhtml")
+        self.assertEqual(parse_head(head, read_file=lambda: content).text, page.title_tag.text)
+
+    def test_content_is_read_once(self):
+        for use_spine_as_toc in (True, False):
+            stats = Stats()
+            archive = EpubArchive("test_data/sicp.epub", use_spine_as_toc, lazy=True, stats=stats)
+            titles = [page.get_page_title() for page in archive.iter_pages()]
+            files = set(page.filename.split("#")[0] for page in archive.pages)
+            self.assertEqual(stats.stages["zip_read"]["calls"], len(files))
+
+    def test_titles_are_counted_from_heads(self):
+        stats = Stats()
+        archive = EpubArchive("test_data/sicp.epub", lazy=True, stats=stats)
+        archive.pages[0].get_page_title()
+        files = set(page.filename.split("#")[0] for page in archive.pages)
+        # Just the first page is read whole, heads of the others are read and dropped
+        self.assertFalse(any(page.loaded for page in archive.pages[1:]))
+        self.assertEqual(stats.stages["zip_read"]["calls"], 1)
+        self.assertEqual(stats.stages["zip_read_head"]["calls"], len(files))
+        z = ZipFile("test_data/sicp.epub")
+        size = sum(z.getinfo(archive.content_path + filename).file_size for filename in files)
+        self.assertTrue(stats.stages["zip_read_head"]["bytes"] * 10 < size)
+
+    def test_titles_survive_unload(self):
+        archive = EpubArchive("test_data/sicp.epub", lazy=True)
+        page = archive.pages[5]
+        title = page.get_page_title()
+        self.assertTrue(page.loaded)
+        page.unload()
+        self.assertFalse(page.loaded)
+        self.assertEqual(page.get_page_title(), title)
+        self.assertFalse(page.loaded)
+        page.set_titles(None, None)
+        self.assertEqual(page.get_page_title(), page.title_in_toc)
+
+class TOCIndexTest(TestCase):
+    def test_lookups(self):
+        toc = EpubArchive("test_data/sicp.epub", False, lazy=True).get_toc()
+        self.assertTrue(len(toc.tree) > 100)
+        for point in toc.tree:
+            self.assertTrue(toc.find_point_by_id(point.id) is point)
+            self.assertEqual(
+                point.find_children(),
+                [n for n in toc.tree if n.parent is not None and n.parent.id == point.id]
+            )
+            self.assertEqual(
+                toc.find_descendants(point),
+                [n for n in toc.tree if point in n.find_ancestors()]
+            )
+        for depth in (1, 2, 3):
+            self.assertEqual(toc.find_points(depth), [p for p in toc.tree if p.depth <= depth])
+        for item in toc.items:
+            self.assertTrue(toc.find_item_by_id(item.id) is item)
+        self.assertEqual(toc.find_point_by_id("no such id"), None)
+
+    def test_navpoint_attributes(self):
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = warnings.append
+        logging.getLogger().addHandler(handler)
+        try:
+            toc = TOC(
+                '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><docTitle><text>Book</text></docTitle><navMap>'
+                '<navPoint id="a" playOrder="7"><navLabel><text> One </text></navLabel><content src="f.html#x"/>'
+                '<navPoint id="b"><navLabel><text>Two</text></navLabel><content src="f.html"/></navPoint></navPoint>'
+                '<navPoint id="c" playOrder="x"><navLabel><text>Three</text></navLabel><content src="g.html"/></navPoint>'
+                '</navMap><navList><navTarget id="t"><navLabel><text>Figure</text></navLabel><content src="g.html#t"/>'
+                '</navTarget></navList></ncx>'
+            )
+            # Missing and invalid playOrder are warned about just when the order is used
+            self.assertEqual([record.getMessage() for record in warnings], [])
+            self.assertEqual([point.order() for point in toc.tree], [7, 2, 3])
+            self.assertEqual([point.order() for point in toc.tree], [7, 2, 3])
+            self.assertEqual(len(warnings), 2)
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual([point.title() for point in toc.tree], ["One", "Two", "Three"])
+        self.assertEqual([point.href() for point in toc.tree], ["f.html#x", "f.html", "g.html"])
+        self.assertEqual([(point.href_file, point.href_fragment) for point in toc.tree],
+                         [("f.html", "x"), ("f.html", None), ("g.html", None)])
+
+    def test_empty_opf_is_skipped(self):
+        ncx = '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><navMap/></ncx>'
+        self.assertEqual(TOC(ncx, '').spine, None)
+        self.assertEqual(TOC(ncx).spine, None)
+        opf = etree.fromstring('<package xmlns="http://www.idpf.org/2007/opf"/>')
+        self.assertTrue(TOC(ncx, opf).spine is opf)
+
+class EpubPackageTest(TestCase):
+    def test_documents_are_parsed_once(self):
+        archive = EpubArchive("test_data/in1.epub")
+        self.assertEqual(archive.opf, None)
+        self.assertEqual(archive.toc, None)
+        toc = archive.get_toc()
+        self.assertTrue(toc.parsed is archive.package.toc)
+        self.assertTrue(toc.spine is archive.package.opf)
+        self.assertEqual(archive.get_language(), "en")
+        self.assertTrue(archive._parsed_metadata is archive.package.opf)
+
+    def test_keep_raw_documents(self):
+        archive = EpubArchive("test_data/in1.epub", keep_raw_documents=True)
+        self.assertTrue(archive.opf.startswith("<?xml"))
+        self.assertTrue("<navMap>" in archive.toc)
+
+class LazyArchiveTest(TestCase):
+    def test_pages_are_parsed_on_access(self):
+        archive = EpubArchive("test_data/sicp.epub", False, lazy=True)
+        self.assertFalse([page for page in archive.pages if page.loaded])
+        page = archive.pages[5]
+        self.assertEqual(len(page.sections), 1)
+        self.assertTrue(page.loaded)
+        self.assertFalse(archive.pages[4].loaded)
+
+    def test_same_pages_as_eager(self):
+        lazy_archive = EpubArchive("test_data/sicp.epub", False, lazy=True)
+        archive = EpubArchive("test_data/sicp.epub", False)
+        self.assertEqual(len(lazy_archive.pages), len(archive.pages))
+        self.assertEqual(
+            [p.get_page_title() for p in lazy_archive.pages],
+            [p.get_page_title() for p in archive.pages]
+        )
+        self.assertEqual(
+            [lazy_archive.pages.index(p.parent_page) for p in lazy_archive.pages if p.parent_page],
+            [archive.pages.index(p.parent_page) for p in archive.pages if p.parent_page]
+        )
+
+    def test_iter_pages_releases_pages(self):
+        archive = EpubArchive("test_data/sicp.epub", False)
+        lazy_archive = EpubArchive("test_data/sicp.epub", False, lazy=True)
+        titles = []
+        for page in lazy_archive.iter_pages():
+            titles.append(page.get_page_title())
+            self.assertEqual([p for p in lazy_archive.pages if p.loaded], [page])
+        self.assertFalse([page for page in lazy_archive.pages if page.loaded])
+        self.assertEqual(titles, [p.get_page_title() for p in archive.pages])
+        page = lazy_archive.pages[5]
+        self.assertEqual(etree.tostring(page.page_content_parsed), etree.tostring(archive.pages[5].page_content_parsed))
+
+class ArchiveLifecycleTest(TestCase):
+    def test_close(self):
+        with EpubArchive("test_data/sicp.epub", False, lazy=True) as archive:
+            self.assertTrue(archive.pages[0].sections)
+        self.assertRaises(ValueError, lambda: archive.pages[-1].sections)
+
+    def test_file_object_and_content(self):
+        titles = [page.get_page_title() for page in EpubArchive("test_data/in1.epub").pages]
+        with open("test_data/in1.epub", "rb") as f:
+            self.assertEqual([page.get_page_title() for page in EpubArchive(f).pages], titles)
+            f.seek(0)
+            archive = EpubArchive(memoryview(f.read()), lazy=True)
+        self.assertEqual([page.get_page_title() for page in archive.pages], titles)
+        archive.close()
+
+    def test_memory_input(self):
+        xml = NetiltDoc("test_data/sicp.epub").process(False)
+        with open("test_data/sicp.epub", "rb") as f:
+            content = f.read()
+            self.assertEqual(NetiltDoc(bytearray(content)).process(False), xml)
+            self.assertEqual(NetiltDoc(memoryview(content)).process(False), xml)
+            self.assertEqual(NetiltDoc(buffer(content)).process(False), xml)
+            self.assertEqual(NetiltDoc(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).process(False), xml)
+        self.assertEqual(NetiltDoc("test_data/sicp.epub", use_mmap=True).process(False), xml)
+        cache = ConversionCache(mkdtemp())
+        try:
+            options = (False, PARSER_AUTO)
+            key = cache.get_key("test_data/sicp.epub", options)
+            self.assertEqual(cache.get_key(memoryview(content), options), key)
+            self.assertEqual(cache.get_key(StringIO(content), options), key)
+        finally:
+            rmtree(cache.directory)
+
+    def test_mapped_file_is_closed(self):
+        archive = EpubArchive("test_data/in1.epub", lazy=True, use_mmap=True)
+        mapped = archive._zip.map
+        archive.close()
+        self.assertRaises(ValueError, mapped.size)
+        pool = ZipFilePool()
+        with EpubArchive("test_data/in1.epub", lazy=True, zip_pool=pool, use_mmap=True) as archive:
+            mapped = archive._zip.map
+            self.assertTrue(archive.pages[0].sections)
+        # Released handle is kept open by the pool until it is closed
+        self.assertTrue(mapped.size())
+        pool.close()
+        self.assertRaises(ValueError, mapped.size)
+
+    def test_zip_pool(self):
+        pool = ZipFilePool(max_handles=1)
+        with EpubArchive("test_data/in1.epub", lazy=True, zip_pool=pool) as archive:
+            EpubArchive("test_data/in1.epub", zip_pool=pool)
+            self.assertEqual(pool.stats(), {"handles": 1, "hits": 1, "misses": 1, "evictions": 0})
+            EpubArchive("test_data/sicp.epub", zip_pool=pool)
+            # The handle of in1.epub is closed even though it is in use,
+            # the archive takes it from the pool again
+            self.assertEqual(len(pool), 1)
+            self.assertTrue(archive.pages[0].sections)
+        EpubArchive("test_data/in1.epub", zip_pool=pool)
+        self.assertEqual(pool.stats(), {"handles": 1, "hits": 2, "misses": 3, "evictions": 2})
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+    def test_zip_pool_of_archives_never_closed(self):
+        pool = ZipFilePool(max_handles=2)
+        directory = mkdtemp()
+        try:
+            archives = []
+            for i in range(5):
+                epub_filename = os.path.join(directory, "%d.epub" % i)
+                copyfile("test_data/in1.epub", epub_filename)
+                archives.append(EpubArchive(epub_filename, lazy=True, zip_pool=pool))
+                self.assertTrue(len(pool) <= 2)
+            titles = [page.get_page_title() for page in EpubArchive("test_data/in1.epub").pages]
+            for archive in archives:
+                self.assertEqual([page.get_page_title() for page in archive.pages], titles)
+                self.assertTrue(archive.pages[-1].sections)
+                self.assertTrue(len(pool) <= 2)
+        finally:
+            pool.close()
+            rmtree(directory)
+
+class ParallelParsingTest(TestCase):
+    def test_same_pages_as_serial(self):
+        for use_spine_as_toc in (True, False):
+            archive = EpubArchive("test_data/sicp.epub", use_spine_as_toc)
+            parallel_archive = EpubArchive("test_data/sicp.epub", use_spine_as_toc, workers=2)
+            # Trees are compared rather than serialized: page parsed in the process
+            # is the parsed document, which is serialized along with its XHTML doctype
+            self.assertEqual(
+                [dump_tree(p.page_content_parsed) for p in parallel_archive.pages],
+                [dump_tree(p.page_content_parsed) for p in archive.pages]
+            )
+            self.assertEqual(
+                [p.get_page_title() for p in parallel_archive.pages],
+                [p.get_page_title() for p in archive.pages]
+            )
+            self.assertEqual(
+                [parallel_archive.pages.index(p.parent_page) for p in parallel_archive.pages if p.parent_page],
+                [archive.pages.index(p.parent_page) for p in archive.pages if p.parent_page]
+            )
+            self.assertEqual(parallel_archive.parser_counts, archive.parser_counts)
+
+    def test_workers_of_lazy_archive(self):
+        self.assertRaises(ValueError, EpubArchive, "test_data/sicp.epub", lazy=True, workers=2)
+        self.assertRaises(ValueError, NetiltDoc, "test_data/sicp.epub", workers=2, manifest_filename="manifest.json")
+        output = StringIO()
+        NetiltDoc("test_data/in1.epub", workers=2).write(output, True)
+        self.assertEqual(output.getvalue(), NetiltDoc("test_data/in1.epub").process(True))
+
+class StreamingWriterTest(TestCase):
+    def test_same_xml_as_process(self):
+        for use_spine_as_toc in (True, False):
+            output = StringIO()
+            NetiltDoc("test_data/sicp.epub").write(output, use_spine_as_toc)
+            self.assertEqual(output.getvalue(), NetiltDoc("test_data/sicp.epub").process(use_spine_as_toc))
+
+class ConversionCacheTest(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_cached_conversion(self):
+        cache = ConversionCache(self.cache_dir)
+        netilt_doc = NetiltDoc("test_data/in1.epub", cache=cache)
+        xml = netilt_doc.process(True)
+        cached_netilt_doc = NetiltDoc("test_data/in1.epub", cache=cache)
+        self.assertEqual(cached_netilt_doc.process(True), xml)
+        self.assertEqual(cached_netilt_doc.epub_archive, None)
+        self.assertEqual(cached_netilt_doc.skeleton, netilt_doc.skeleton)
+        output = StringIO()
+        NetiltDoc("test_data/in1.epub", cache=cache).write(output, True)
+        self.assertEqual(output.getvalue(), xml)
+        NetiltDoc("test_data/in1.epub", cache=cache).process(False)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_eviction(self):
+        cache = ConversionCache(self.cache_dir, max_bytes=1)
+        NetiltDoc("test_data/in1.epub", cache=cache).process(True)
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_directory_is_listed_for_eviction_only(self):
+        # Entries take 102 bytes
+        cache = ConversionCache(self.cache_dir, max_bytes=1500, scan_interval=100)
+        for index in range(20):
+            cache.put("key%d" % index, "x" * 100, {})
+        # Listed at the first put and when the cache got over max_bytes (at puts 15, 17 and 19),
+        # two entries are evicted each time
+        self.assertEqual(cache.scans, 4)
+        self.assertEqual(cache.evictions, 6)
+        self.assertEqual(cache.stats()["entries"], 14)
+        self.assertEqual(cache.get("key0"), None)
+        self.assertTrue(cache.get("key19") is not None)
+
+    def test_stale_temporary_files_are_removed(self):
+        cache = ConversionCache(self.cache_dir)
+        stale_file = cache.new_file()
+        stale_file.write("partial")
+        stale_file.close()
+        hour_ago = time.time() - cache.STALE_TMP_SECONDS - 1
+        os.utime(stale_file.name, (hour_ago, hour_ago))
+        new_file = cache.new_file()
+        new_file.close()
+        cache.put("key", "xml", {})
+        self.assertFalse(os.path.exists(stale_file.name))
+        self.assertTrue(os.path.exists(new_file.name))
+        self.assertEqual(cache.stats()["entries"], 1)
+
+class IncrementalConversionTest(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def change_epub(self, filename, replacements):
+        """Writes sicp.epub with replacements (dict of file name: (old, new)) to filename"""
+        source = ZipFile("test_data/sicp.epub")
+        changed = ZipFile(filename, "w")
+        for info in source.infolist():
+            content = source.read(info.filename)
+            if info.filename in replacements:
+                content = content.replace(*replacements[info.filename])
+            changed.writestr(info, content)
+        changed.close()
+
+    def parsed_files(self, stats):
+        return set([page["filename"].split("#")[0] for page in stats.pages if "parse" in page["seconds"]])
+
+    def test_only_changed_pages_are_parsed(self):
+        changed_epub = os.path.join(self.directory, "changed.epub")
+        self.change_epub(changed_epub, {"OEBPS/book-Z-H-10.html": ("procedure", "PROCEDURE")})
+        manifest_filename = os.path.join(self.directory, "sicp.json")
+        output_filename = os.path.join(self.directory, "sicp.xml")
+        xml = NetiltDoc("test_data/sicp.epub").process(False)
+        NetiltDoc("test_data/sicp.epub", manifest_filename=manifest_filename).write(output_filename, False)
+        self.assertEqual(open(output_filename).read(), xml)
+        # Just titles and offsets of the pages are kept in the manifest
+        self.assertTrue(os.path.getsize(manifest_filename) * 10 < len(xml))
+        stats = Stats()
+        self.assertEqual(NetiltDoc("test_data/sicp.epub", manifest_filename=manifest_filename, stats=stats).process(False), xml)
+        self.assertEqual(self.parsed_files(stats), set())
+        stats = Stats()
+        NetiltDoc(changed_epub, manifest_filename=manifest_filename, stats=stats).write(output_filename, False)
+        self.assertEqual(open(output_filename).read(), NetiltDoc(changed_epub).process(False))
+        self.assertEqual(self.parsed_files(stats), set(["book-Z-H-10.html"]))
+        # The manifest describes the new output
+        stats = Stats()
+        self.assertEqual(NetiltDoc(changed_epub, manifest_filename=manifest_filename, stats=stats).process(False),
+                         open(output_filename).read())
+        self.assertEqual(self.parsed_files(stats), set())
+
+    def test_changed_output_is_not_reused(self):
+        manifest_filename = os.path.join(self.directory, "sicp.json")
+        output_filename = os.path.join(self.directory, "sicp.xml")
+        NetiltDoc("test_data/sicp.epub", manifest_filename=manifest_filename).write(output_filename, False)
+        with open(output_filename, "a") as f:
+            f.write("\n")
+        stats = Stats()
+        self.assertEqual(NetiltDoc("test_data/sicp.epub", manifest_filename=manifest_filename, stats=stats).process(False),
+                         NetiltDoc("test_data/sicp.epub").process(False))
+        self.assertEqual(stats.stages["convert_page"]["reused"], 0)
+
+    def test_shared_file_is_released(self):
+        # Pages of the navpoint and of its neighbours get other keys, the rest of the file is reused
+        changed_epub = os.path.join(self.directory, "changed.epub")
+        self.change_epub(changed_epub, {"OEBPS/toc.ncx": ('book-Z-H-10.html#heading_id_5"', 'book-Z-H-10.html#heading_id_5x"')})
+        manifest_filename = os.path.join(self.directory, "sicp.json")
+        output_filename = os.path.join(self.directory, "sicp.xml")
+        NetiltDoc("test_data/sicp.epub", manifest_filename=manifest_filename).write(output_filename, False)
+        netilt_doc = NetiltDoc(changed_epub, manifest_filename=manifest_filename)
+        netilt_doc.write(output_filename, False)
+        self.assertEqual(open(output_filename).read(), NetiltDoc(changed_epub).process(False))
+        pages = [page for page in netilt_doc.epub_archive.pages if page.filename.startswith("book-Z-H-10.html#")]
+        converted_pages = [page for page in pages if page.shared_content is not None]
+        self.assertTrue(0 < len(converted_pages) < len(pages))
+        self.assertEqual([page.shared_content._html for page in converted_pages], [None] * len(converted_pages))
+
+class SyntheticEpubTest(TestCase):
+    def test_make_epub(self):
+        directory = mkdtemp()
+        try:
+            epub_filename = os.path.join(directory, "synthetic.epub")
+            make_epub(epub_filename, files_count=4, navpoints_per_file=3, elements_per_page=300)
+            archive = EpubArchive(epub_filename, False)
+            self.assertEqual(len(archive.pages), 12)
+            self.assertEqual(archive.parser_counts, {"xhtml": 12, "soup": 0})
+            self.assertEqual([page.get_page_title() for page in archive.pages[:3]], ["Part 0.0", "Part 0.1", "Part 0.2"])
+            self.assertEqual(len(EpubArchive(epub_filename, True).pages), 4)
+        finally:
+            rmtree(directory)
+
+    def test_nested_navpoints(self):
+        directory = mkdtemp()
+        try:
+            epub_filename = os.path.join(directory, "synthetic.epub")
+            make_epub(epub_filename, files_count=3, navpoints_per_file=4, elements_per_page=300, depth=3,
+                      children_count=2, malformed_every=3, unique_titles=False)
+            archive = EpubArchive(epub_filename, False)
+            self.assertEqual(archive.parser_counts, {"xhtml": 8, "soup": 4})
+            self.assertEqual(
+                [archive.pages.index(page.parent_page) if page.parent_page else None for page in archive.pages[:7]],
+                [None, 0, 1, 1, 0, 4, 4]
+            )
+            self.assertEqual(archive.pages[4].get_page_title(), "Part 1.0")
+            metas = archive.package.toc.findall(".//{http://www.daisy.org/z3986/2005/ncx/}meta")
+            self.assertEqual(dict((meta.get("name"), meta.get("content")) for meta in metas), {
+                "dtb:uid": "synthetic", "dtb:depth": "3", "dtb:totalPageCount": "0", "dtb:maxPageNumber": "0"
+            })
+        finally:
+            rmtree(directory)
+
+class BatchTest(TestCase):
+    def test_failures_are_isolated(self):
+        output_dir = mkdtemp()
+        try:
+            not_epub = os.path.join(output_dir, "not_epub.epub")
+            with open(not_epub, "w") as f:
+                f.write("not a zip file")
+            report = convert_books(["test_data/in1.epub", not_epub, "test_data/sicp.epub"], output_dir, processes=2)
+            self.assertEqual(report["books"], 3)
+            self.assertEqual(report["converted"], 2)
+            self.assertEqual(report["failed"], 1)
+            self.assertEqual([result["error"] is None for result in report["results"]], [True, False, True])
+            self.assertEqual(
+                open(report["results"][0]["output"]).read(),
+                NetiltDoc("test_data/in1.epub").process(True)
+            )
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "sicp.xml")))
+        finally:
+            rmtree(output_dir)
+
+    def test_same_names_in_subdirectories(self):
+        directory = mkdtemp()
+        try:
+            for (subdirectory, book) in (("a", "in1"), ("b", "sicp")):
+                os.makedirs(os.path.join(directory, "books", subdirectory))
+                copyfile("test_data/%s.epub" % book, os.path.join(directory, "books", subdirectory, "book.epub"))
+            output_dir = os.path.join(directory, "output")
+            report = convert_books(find_epub_files([os.path.join(directory, "books"), "test_data/in1.epub"]),
+                                   output_dir, processes=1, with_stats=True)
+            self.assertEqual(report["failed"], 0)
+            self.assertEqual([result["output"] for result in report["results"]], [
+                os.path.join(output_dir, "a", "book.xml"), os.path.join(output_dir, "b", "book.xml"),
+                os.path.join(output_dir, "in1.xml")
+            ])
+            self.assertEqual(open(os.path.join(output_dir, "b", "book.xml")).read(),
+                             NetiltDoc("test_data/sicp.epub").process(True))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "a", "book.stats.json")))
+        finally:
+            rmtree(directory)
+
+    def test_names_differing_in_case(self):
+        self.assertEqual(get_output_filenames(["x/Book.epub", "x/book.epub", "y/BOOK.epub"], "output"), [
+            os.path.join("output", "x", "Book.xml"), os.path.join("output", "x", "book-2.xml"),
+            os.path.join("output", "y", "BOOK.xml")
+        ])
+
+    def test_repeated_and_failed_books(self):
+        directory = mkdtemp()
+        try:
+            bad_epub = os.path.join(directory, "bad.epub")
+            with open(bad_epub, "wb") as f:
+                f.write("not a zip file")
+            output_dir = os.path.join(directory, "output")
+            report = convert_books(["test_data/in1.epub", "./test_data/in1.epub", bad_epub], output_dir, processes=1)
+            self.assertEqual((report["books"], report["converted"], report["failed"]), (2, 1, 1))
+            # Failed conversion leaves no partial output
+            self.assertEqual(os.listdir(output_dir), ["in1.xml"])
+        finally:
+            rmtree(directory)
+
+    def test_no_books(self):
+        directory = mkdtemp()
+        try:
+            # Directory without epub files
+            self.assertEqual(batch_main([os.path.join(directory, "output"), directory]), 0)
+        finally:
+            rmtree(directory)
+
+class ImageExtractionTest(TestCase):
+    def test_extract_images(self):
+        archive = EpubArchive("test_data/in1.epub", lazy=True)
+        directory = mkdtemp()
+        try:
+            images = list(archive.extract_images(directory, chunk_size=1024))
+            self.assertTrue(images)
+            z = ZipFile("test_data/in1.epub")
+            for image in images:
+                self.assertEqual(open(image.output, "rb").read(), z.read(image.archive_filename))
+                self.assertEqual(image.output, os.path.join(directory, image.href))
+                self.assertEqual(image.size, len(z.read(image.archive_filename)))
+        finally:
+            rmtree(directory)
+
+    def test_extract_images_in_thread(self):
+        archive = EpubArchive("test_data/sicp.epub", lazy=True)
+        outputs = {}
+        def sink(image):
+            outputs[image.href] = StringIO()
+            outputs[image.href].close = lambda: None
+            return outputs[image.href]
+        extractor = archive.extract_images_in_thread(sink)
+        for page in archive.iter_pages():
+            page.sections
+        extractor.join()
+        self.assertEqual(extractor.error, None)
+        self.assertEqual(sorted(outputs.keys()), sorted([image.href for image in extractor.images]))
+        image = extractor.images[0]
+        self.assertEqual(outputs[image.href].getvalue(), ZipFile("test_data/sicp.epub").read(image.archive_filename))
+
+    def test_extract_images_in_thread_from_file_object(self):
+        archive = EpubArchive("test_data/sicp.epub", lazy=True)
+        titles = [page.get_page_title() for page in archive.pages]
+        with open("test_data/sicp.epub", "rb") as f:
+            archive = EpubArchive(f, lazy=True)
+            outputs = {}
+            def sink(image):
+                outputs[image.href] = StringIO()
+                outputs[image.href].close = lambda: None
+                return outputs[image.href]
+            # Small chunks, so that the thread reads the file along with the pages
+            extractor = archive.extract_images_in_thread(sink, chunk_size=16)
+            self.assertEqual([page.get_page_title() for page in archive.iter_pages()], titles)
+            extractor.join()
+        self.assertEqual(extractor.error, None)
+        z = ZipFile("test_data/sicp.epub")
+        for image in extractor.images:
+            self.assertEqual(outputs[image.href].getvalue(), z.read(image.archive_filename))
+
+class StatsTest(TestCase):
+    def test_stats(self):
+        stats = Stats()
+        xml = NetiltDoc("test_data/sicp.epub", stats=stats).process(False)
+        self.assertEqual(xml, NetiltDoc("test_data/sicp.epub").process(False))
+        for stage in ("read_package", "toc", "zip_read", "parse", "find_bounding_elements",
+                      "parse_sections", "convert_page", "serialization"):
+            self.assertTrue(stats.stages[stage]["calls"] > 0, stage)
+        self.assertEqual(stats.stages["convert_page"]["calls"], len(stats.pages))
+        self.assertTrue(stats.stages["parse"]["elements"] > 0)
+        self.assertTrue("parse_sections" in stats.pages[0]["seconds"])
+        output = StringIO()
+        stats.dump(output)
+        self.assertEqual(json.loads(output.getvalue())["stages"]["toc"]["calls"], 1)
+
+class MetadataTest(TestCase):
+    def test_same_as_archive(self):
+        for filename in ("test_data/in1.epub", "test_data/sicp.epub"):
+            archive = EpubArchive(filename, lazy=True)
+            self.assertEqual(read_metadata(filename), {
+                "title": archive.title,
+                "authors": archive.authors,
+                "subjects": list(archive.get_subjects() or []),
+                "language": archive.get_language(),
+                "publisher": list(archive.get_publisher() or []),
+                "rights": archive.get_rights(),
+                "description": archive.get_description(),
+            })
+        with open("test_data/in1.epub", "rb") as f:
+            self.assertEqual(read_metadata(memoryview(f.read())), read_metadata("test_data/in1.epub"))
+
+    def test_only_container_and_opf_are_read(self):
+        for filename in ("test_data/in1.epub", "test_data/sicp.epub"):
+            opf_filenames = [name for name in ZipFile(filename).namelist() if name.endswith(".opf")]
+            read_files = set()
+            zip_open, zip_read = ZipFile.open, ZipFile.read
+            def open_file(archive, name, *args, **kwargs):
+                read_files.add(getattr(name, "filename", name))
+                return zip_open(archive, name, *args, **kwargs)
+            def read_file(archive, name, *args, **kwargs):
+                read_files.add(getattr(name, "filename", name))
+                return zip_read(archive, name, *args, **kwargs)
+            ZipFile.open, ZipFile.read = open_file, read_file
+            try:
+                read_metadata(filename)
+            finally:
+                ZipFile.open, ZipFile.read = zip_open, zip_read
+            self.assertEqual(read_files, set(["META-INF/container.xml"] + opf_filenames))
+
+    def test_read_books(self):
+        directory = mkdtemp()
+        try:
+            not_epub = os.path.join(directory, "not_epub.epub")
+            with open(not_epub, "w") as f:
+                f.write("not a zip file")
+            filenames = ["test_data/in1.epub", not_epub, "test_data/sicp.epub"]
+            for processes in (1, 2):
+                records = list(read_books(filenames, processes))
+                self.assertEqual([record["epub"] for record in records], filenames)
+                self.assertEqual([record["error"] is None for record in records], [True, False, True])
+                self.assertEqual(records[2]["title"], "Structure and Interpretation of Computer Programs")
+        finally:
+            rmtree(directory)
+
 class NetiltDocTest(TestCase):
     def test_navpoints_page_title(self):
         netilt_xml = NetiltDoc("test_data/nested_navpoints.epub").get_netilt_xml(False)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from lxml import etree as ET
-import sys, logging
+import sys, logging, heapq, time
 
 from constants import NAMESPACES as NS
 from constants import ENC
@@ -30,18 +30,34 @@ class TOC():
     doc_title = None
     spine = None
 
-    def __init__(self, toc_string, opf_string=None):
-        '''If provided, an optional opf file will inform the parsing of the ncx file'''
-        self.parsed = xml_from_string(toc_string)
-
-        if opf_string:
-            self.spine = xml_from_string(opf_string)
+    def __init__(self, toc_string, opf_string=None, stats=None):
+        '''If provided, an optional opf file will inform the parsing of the ncx file.
+        Both documents might be passed either as strings or already parsed.
+        If stats (stats.Stats) is given, parsing is recorded in it as "toc" stage'''
+        if stats is not None:
+            start = time.time()
+        self.parsed = parsed_xml(toc_string)
+
+        # Empty opf string is skipped as before; parsed document is tested against None,
+        # as truth value of an element is whether it has children
+        if isinstance(opf_string, basestring):
+            if opf_string:
+                self.spine = xml_from_string(opf_string)
+        elif opf_string is not None:
+            self.spine = opf_string
     
         self.tree = []
         self.items = []
         self.lists = []
+        # Indexes for navigation, built while parsing
+        self._points_by_id = {}
+        self._children_by_id = {}
+        self._points_by_depth = {}
+        self._items_by_id = {}
         self.parse() 
         self.parse_auxilliary()
+        if stats is not None:
+            stats.add("toc", time.time() - start, navpoints=len(self.tree))
 
     def parse_auxilliary(self):
         '''Parses any auxilliary nav lists and adds them to self.lists'''
@@ -60,6 +76,7 @@ class TOC():
            
         for navmap in self.parsed.findall('.//{%s}navMap' % (NS['ncx'])):
             self._find_point(navmap)
+        resolve_orders(self.tree)
 
         # If we have a spine, we use that to define our next/previous tree, and then
         # find children of each spine element in the NCX, just for display
@@ -90,6 +107,7 @@ class TOC():
                                        navpoint=navpoint,
                                        linear=spine_itemref.get('linear'),
                                        toc=self))
+                self._items_by_id.setdefault(item.get('id'), self.items[-1])
 
             
     def __str__(self):
@@ -124,19 +142,16 @@ class TOC():
             
     def find_points(self, maxdepth=1):
         '''Return all the navpoints in the TOC having a maximum depth of maxdepth'''
-        return [p for p in self.tree if p.depth <= maxdepth]
+        points = [self._points_by_depth[depth] for depth in self._points_by_depth if depth <= maxdepth]
+        return [p for (index, p) in heapq.merge(*points)]
 
     def find_point_by_id(self, node_id):
         '''For accessing a node in the tree from an id'''
-        for n in self.tree:
-            if n.element.get('id') == node_id:
-                return n
+        return self._points_by_id.get(node_id)
 
     def find_item_by_id(self, item_id):
         '''For accessing a node in the item list from an id'''
-        for n in self.items:
-            if n.id == item_id:
-                return n
+        return self._items_by_id.get(item_id)
 
     def find_next_item(self, item):
         i = self._get_index_by_item(item)
@@ -168,15 +183,26 @@ class TOC():
 
     def find_children(self, element):
         '''Find all the children of a node (for expand/collapse navigation)'''
-        return [n for n in self.tree if n.parent is not None and n.parent.element.get('id') == element.element.get('id')]
+        return list(self._children_by_id.get(element.id, []))
 
     def find_descendants(self, element):
         '''Find all the descendants of a node'''
-        return [n for n in self.tree if n != element and n.parent is not None and element in n.find_ancestors()]
+        descendants = []
+        stack = list(reversed(element.children))
+        while stack:
+            n = stack.pop()
+            descendants.append(n)
+            stack.extend(reversed(n.children))
+        return descendants
         
     def _find_point(self, element, parent=None, depth=1):
         for nav in element.findall('{%s}navPoint' % (NS['ncx'])):
-            n = NavPoint(nav, depth, parent=parent, doc_title=self.doc_title, tree=self.tree)
+            n = NavPoint(nav, depth, parent=parent, doc_title=self.doc_title, tree=self.tree, toc=self)
+            self._points_by_id.setdefault(n.id, n)
+            self._points_by_depth.setdefault(depth, []).append((len(self.tree), n))
+            if parent is not None:
+                parent.children.append(n)
+                self._children_by_id.setdefault(parent.id, []).append(n)
             self.tree.append(n)
             self._find_point(nav, parent=n, depth=depth+1)
 
@@ -217,17 +243,46 @@ class Item():
             return navpoint.__str__()
         return unicode(self.label, encoding=ENC) + u"\n"
 
-class NavPoint():
-    '''Hold an individual navpoint, including its text, label and parent relationship.'''
-    def __init__(self, element, depth=1, parent=None, doc_title=None, tree=None):
+class NavPoint(object):
+    '''Hold an individual navpoint, including its text, label and parent relationship.
+    Label, title, href (split into href_file and href_fragment) and play order are read
+    from the element once. Order of navpoints without valid playOrder is their position
+    in the tree, which is set by resolve_orders once the tree is built; invalid playOrder
+    is warned about when the order is used'''
+
+    __slots__ = ('element', 'id', 'depth', 'parent', 'doc_title', 'tree', 'toc', 'label',
+                 'ancestors', 'children', '_title', '_href', 'href_file', 'href_fragment', '_order',
+                 '_invalid_order')
+
+    def __init__(self, element, depth=1, parent=None, doc_title=None, tree=None, toc=None):
         self.element = element
         self.id = self.element.get('id')
         self.depth = depth
         self.parent = parent
         self.doc_title = doc_title
         self.tree = tree
+        self.toc = toc
         self.label = get_label(self.element)
         self.ancestors = []
+        self.children = []
+        self._title = self.label.strip() if self.label is not None else ""
+        content = self.element.find('.//{%s}content' % (NS['ncx']))
+        self._href = content.get('src') if content is not None else None
+        if self._href is not None:
+            parts = self._href.split("#")
+            self.href_file = parts[0]
+            self.href_fragment = parts[1] if len(parts) > 1 else None
+        else:
+            self.href_file = None
+            self.href_fragment = None
+        try:
+            self._order = int(self.element.get('playOrder'))
+            self._invalid_order = False
+        except (ValueError, TypeError):
+            self._order = None
+            self._invalid_order = True
+        if self._order is None and tree is None:
+            self._order = 0
 
     def find_ancestors(self):
         '''All the parents of our parent, which will allow for deeper exploration of the tree'''
@@ -242,40 +297,41 @@ class NavPoint():
 
     def find_children(self):
         '''Returns all the children of this NavPoint'''
-        return [n for n in self.tree if n.parent is not None and n.parent.element.get('id') == self.element.get('id')]
+        if self.toc is not None:
+            return self.toc.find_children(self)
+        return [n for n in self.tree if n.parent is not None and n.parent.id == self.id]
         
     def find_descendants(self):
         '''Find all the descendants of a node'''
+        if self.toc is not None:
+            return self.toc.find_descendants(self)
         return [n for n in self.tree if n != self and n.parent is not None and self in n.find_ancestors()]
 
 
     def title(self):
-        return self.element.findtext('.//{%s}text' % (NS['ncx']), "").strip()
+        return self._title
 
     def order(self):
-        try:
-            return int(self.element.get('playOrder'))
-        except ValueError:
-            logging.warning("Got non-numeric value from playOrder: %s" % self.element.get('playOrder'))
-        except TypeError:
-            logging.warning('Could not find playOrder value in %s' % self.element)
-        # Get it by counting where we are from the parent; I want to use
-        # self::*/position() here but lxml is complaining
-        if not self.tree:
-            return 0
-        else:
-            for index, x in enumerate(self.tree):
-                if x.id == self.id:
-                    return index + 1
+        if self._invalid_order:
+            self._invalid_order = False
+            play_order = self.element.get('playOrder')
+            if play_order is None:
+                logging.warning('Could not find playOrder value in %s' % self.element)
+            else:
+                logging.warning("Got non-numeric value from playOrder: %s" % play_order)
+        if self._order is None and self.tree:
+            # Navpoint of a tree which is not built by TOC, see resolve_orders
+            resolve_orders(self.tree)
+        return self._order if self._order is not None else 0
 
     def href(self):
-        return self.element.find('.//{%s}content' % (NS['ncx'])).get('src')
+        return self._href
 
     def __str__(self):
         res = u''
         for n in range(1,self.depth):
             res += u' '
-        text = self.element.findtext('.//{%s}text' % NS['ncx'])
+        text = self.label
         if type(text) == unicode:
             res += text
         else:
@@ -289,7 +345,16 @@ class NavPoint():
 
 class NavTarget(NavPoint):
     '''A subclass of NavPoint which is found in ncx:navList rather than ncx:navMap'''
-    pass
+    __slots__ = ()
+
+def resolve_orders(tree):
+    '''Sets order of the navpoints of tree which have no valid playOrder to the position in tree
+    (counting from 1) of the first navpoint with the same id'''
+    positions = {}
+    for (index, navpoint) in enumerate(tree):
+        positions.setdefault(navpoint.id, index + 1)
+        if navpoint._order is None:
+            navpoint._order = positions[navpoint.id]
 
 class NavList():
     '''An auxilliary content list, as a list of illustrations'''
@@ -320,5 +385,10 @@ def xml_from_string(xml):
             return ET.fromstring(xml.encode(ENC))
         except ET.XMLSyntaxError:
             raise InvalidEpubException("Unable to parse file")
-    return ET.fromstring(xml)    
+    return ET.fromstring(xml)
 
+def parsed_xml(xml):
+    '''Parses xml string with xml_from_string; already parsed document is returned as is'''
+    if isinstance(xml, basestring):
+        return xml_from_string(xml)
+    return xml